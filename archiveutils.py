@@ -0,0 +1,186 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+from batchutils import nquads_suffix, to_nquad, to_ntriples
+from fileutils import iter_file_range
+
+# Suffix of the index of an archive
+INDEX_SUFFIX = '.index'
+
+# Graphs up to this size are collected in memory before they are appended to the archive
+SPOOL_SIZE = 8 * 1024 * 1024
+
+# Size of chunks in which graphs are copied to shards and read from them
+CHUNK_SIZE = 64 * 1024
+
+# Content types of N-Triples responses, which are converted to N-Quads line by line
+NTRIPLES_TYPES = ('application/n-triples', 'text/plain')
+
+
+def is_archive(path):
+    return os.path.isfile(path + INDEX_SUFFIX)
+
+
+class GraphArchive(object):
+    """
+    Dataset stored as N-Quads in one file or a few shard files instead of a file per graph.
+    Statements of each graph are stored contiguously, an index in a SQLite database next to
+    the archive maps graphs to shard, offset, length and number of statements, so that a single
+    graph is read without scanning. Shard 0 is path itself, further shards are path.1, path.2 ...
+    Graphs are appended to the smallest shard, a graph added again replaces its previous
+    version in the index, the old statements remain unreferenced in the shard.
+    """
+
+    def __init__(self, path, shards=1):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path + INDEX_SUFFIX, timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS graphs (
+                graph TEXT NOT NULL PRIMARY KEY,
+                shard TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                statements INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT)""")
+        self.shards = [os.path.basename(path)] + ['%s.%i' % (os.path.basename(path), i) for i in range(1, shards)]
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, shard)
+
+    def entry(self, graph):
+        """
+        :return: dictionary with keys shard, offset, length, statements, etag and last_modified, or None
+        """
+        with self.lock:
+            row = self.db.execute("SELECT shard, offset, length, statements, etag, last_modified FROM graphs "
+                                  "WHERE graph = ?", (graph,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('shard', 'offset', 'length', 'statements', 'etag', 'last_modified'), row))
+
+    def graphs(self):
+        """
+        :return: dictionary mapping all graphs in the archive to their length in bytes
+        """
+        with self.lock:
+            return dict(self.db.execute("SELECT graph, length FROM graphs"))
+
+    def writer(self, graph, format=None):
+        return GraphWriter(self, graph, format)
+
+    def add(self, graph, writer, etag=None, last_modified=None):
+        """
+        Appends the statements collected by writer to the smallest shard and records them in the index.
+        """
+        writer.close()
+        with self.lock:
+            sizes = []
+            for shard in self.shards:
+                path = self.shard_path(shard)
+                sizes.append((os.path.getsize(path) if os.path.exists(path) else 0, shard))
+            offset, shard = min(sizes)
+            with open(self.shard_path(shard), 'ab') as fd:
+                writer.spool.seek(0)
+                shutil.copyfileobj(writer.spool, fd, CHUNK_SIZE)
+                fd.flush()
+                os.fsync(fd.fileno())
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO graphs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (graph, shard, offset, writer.length, writer.statements, etag, last_modified))
+        writer.discard()
+
+    def iter_raw(self, entry, start=0, end=None):
+        """
+        Yields bytes start to end (by default all) of the N-Quads of an entry in chunks.
+        """
+        if end is None:
+            end = entry['length']
+        return iter_file_range(self.shard_path(entry['shard']), entry['offset'] + start, entry['offset'] + end,
+                               CHUNK_SIZE)
+
+    def iter_ntriples(self, graph, entry=None, start=0, end=None):
+        """
+        Yields the statements of graph as N-Triples in non-empty chunks, start and end select
+        a range of whole lines of the N-Quads.
+        """
+        if entry is None:
+            entry = self.entry(graph)
+        suffix = nquads_suffix(graph)
+        rest = b''
+        for chunk in self.iter_raw(entry, start, end):
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            if lines:
+                # Lines end with suffix without its newline
+                yield b''.join(line[:1 - len(suffix)] + b' .\n' for line in lines)
+
+    def read_ntriples(self, graph):
+        """
+        :return: statements of graph as N-Triples
+        """
+        return b''.join(self.iter_ntriples(graph))
+
+    @staticmethod
+    def ntriples_length(graph, length, statements):
+        """
+        :return: length of N-Quads of graph with length bytes and number of statements converted to N-Triples
+        """
+        return length - statements * (len(nquads_suffix(graph)) - len(b' .\n'))
+
+    def close(self):
+        self.db.close()
+
+
+class GraphWriter(object):
+    """
+    Collects statements of a graph written as N-Triples chunks and converts them to N-Quads.
+    Statements are spooled to a temporary file when they exceed SPOOL_SIZE. Graphs written
+    in another format (an rdflib format name or media type) are converted when complete.
+    """
+
+    def __init__(self, archive, graph, format=None):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=archive.directory)
+        self.suffix = nquads_suffix(graph)
+        self.format = format
+        self.chunks = []  # graph in format
+        self.rest = b''
+        self.length = 0
+        self.statements = 0
+
+    def write_line(self, line):
+        line = line.strip()
+        if not line or line.startswith(b'#'):
+            return
+        line = to_nquad(line, self.suffix)
+        self.spool.write(line)
+        self.length += len(line)
+        self.statements += 1
+
+    def write(self, chunk):
+        if self.format is not None:
+            self.chunks.append(chunk)
+            return
+        lines = (self.rest + chunk).split(b'\n')
+        self.rest = lines.pop()
+        for line in lines:
+            self.write_line(line)
+
+    def close(self):
+        if self.format is not None:
+            data, format = b''.join(self.chunks), self.format
+            self.format = None
+            self.chunks = []
+            self.write(to_ntriples(data, format))
+        self.write_line(self.rest)
+        self.rest = b''
+
+    def discard(self):
+        self.spool.close()
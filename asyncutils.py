@@ -0,0 +1,184 @@
+import asyncio
+import time
+
+import requests
+
+from metricsutils import collect_latencies, set_graph
+from taskutils import IDLE_INTERVAL, TaskScheduler, _SchedulerState, task_graph
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Size of chunks returned by AsyncResponse.aiter_content by default
+CHUNK_SIZE = 64 * 1024
+
+
+class AsyncSession(object):
+    """
+    Asynchronous counterpart of the requests session created by httputils.create_session,
+    used by tasks run with the async engine. Connections are kept alive and shared by all
+    coroutines, at most pool_size connections are open at a time. Failures are reported
+    with requests exceptions, so that retries are classified like in the thread engine.
+    """
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, http2=False):
+        if httpx is None:
+            raise Exception("async engine requires httpx package (pip install httpx)")
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=read_timeout, pool=None)
+        self.http2 = http2
+        self.clients = {}  # verify -> httpx async client
+
+    def _client(self, verify):
+        client = self.clients.get(verify)
+        if client is None:
+            client = self.clients[verify] = httpx.AsyncClient(http2=self.http2, limits=self.limits,
+                                                              timeout=self.timeout, verify=verify)
+        return client
+
+    async def request(self, method, url, headers=None, data=None, verify=True, stream=False):
+        """
+        Sends a request, the body of the response is read unless stream is True.
+        :return: AsyncResponse
+        """
+        client = self._client(verify)
+        request = client.build_request(method, url, headers=headers, content=data)
+        try:
+            http_response = await client.send(request, stream=True)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e)
+        response = AsyncResponse(http_response)
+        if not stream:
+            try:
+                await response.read()
+            finally:
+                await response.aclose()
+        return response
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+
+
+class AsyncResponse(object):
+    """
+    Response of AsyncSession.request with the parts of the requests response interface used by tasks.
+    """
+
+    def __init__(self, http_response):
+        self.http_response = http_response
+        self.status_code = http_response.status_code
+        self.reason = http_response.reason_phrase
+        self.headers = http_response.headers
+        self.url = str(http_response.url)
+        self.content = None
+
+    async def read(self):
+        self.content = b''.join([chunk async for chunk in self.aiter_content()])
+        return self.content
+
+    async def aiter_content(self, chunk_size=CHUNK_SIZE):
+        try:
+            async for chunk in self.http_response.aiter_bytes(chunk_size):
+                yield chunk
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e)
+
+    async def aiter_raw(self, chunk_size=CHUNK_SIZE):
+        """
+        Iterates over the body as it was transferred, without decoding the content encoding.
+        """
+        try:
+            async for chunk in self.http_response.aiter_raw(chunk_size):
+                yield chunk
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e)
+
+    async def aclose(self):
+        await self.http_response.aclose()
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise requests.HTTPError('%s %s Error: %s for url: %s' % (self.status_code, kind, self.reason, self.url),
+                                     response=self)
+
+
+class AsyncTaskScheduler(TaskScheduler):
+    """
+    TaskScheduler running tasks as coroutines on a single event loop instead of a thread pool,
+    so that max_workers can be in the thousands. Task must have coroutine method run_async()
+    instead of run(), endpoint limits and retries are the same as in TaskScheduler. Sessions
+    of the started tasks with method aclose() are closed when all tasks finished.
+    """
+
+    def run(self, tasks, on_progress=None, on_error=None):
+        """
+        Runs all tasks.
+        :return: tuple (list of successful tasks, list of failed tasks)
+        """
+        return asyncio.run(self._run(tasks, on_progress, on_error))
+
+    async def _run(self, tasks, on_progress, on_error):
+        sessions = {}
+        state = _SchedulerState(self, tasks, on_progress, on_error)
+        finished = asyncio.Queue()
+        running = set()  # keeps references to running coroutines
+        in_flight = 0
+        try:
+            while state.pending() or in_flight:
+                while in_flight < self.max_workers:
+                    task = state.next_task()
+                    if task is None:
+                        break
+                    session = getattr(task, 'session', None)
+                    if hasattr(session, 'aclose'):
+                        sessions[id(session)] = session
+                    future = asyncio.ensure_future(self._run_task(task, finished))
+                    running.add(future)
+                    future.add_done_callback(running.discard)
+                    in_flight += 1
+
+                timeout = state.timeout()
+                if not in_flight:
+                    await asyncio.sleep(IDLE_INTERVAL if timeout is None else timeout)
+                    continue
+                try:
+                    result = await asyncio.wait_for(finished.get(), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                while True:
+                    in_flight -= 1
+                    state.finish(*result)
+                    if finished.empty():
+                        break
+                    result = finished.get_nowait()
+        finally:
+            for future in list(running):
+                future.cancel()
+            for session in sessions.values():
+                await session.aclose()
+
+        return state.done_tasks, state.failed_tasks
+
+    @staticmethod
+    async def _run_task(task, finished):
+        start = time.time()
+        exc = None
+        # Each coroutine runs in a context of its own
+        set_graph(task_graph(task))
+        latencies = collect_latencies()
+        try:
+            await task.run_async()
+        except Exception as e:
+            exc = e
+        finished.put_nowait((task, time.time() - start, exc, latencies))
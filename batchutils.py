@@ -0,0 +1,259 @@
+import rdflib
+import requests
+
+from metricsutils import timed
+from taskutils import is_retryable, task_endpoints
+
+BATCH_METHODS = ('update', 'quads')
+
+# Default budget of a batch
+DEFAULT_BATCH_GRAPHS = 1000
+DEFAULT_BATCH_TRIPLES = 100000
+DEFAULT_BATCH_BYTES = 16 * 1024 * 1024
+
+
+def make_batches(graphs, sizes, max_size, max_graphs=DEFAULT_BATCH_GRAPHS):
+    """
+    Packs graphs in order into batches of at most max_graphs graphs whose sizes sum up to at most max_size.
+    :param sizes: dictionary mapping graph names to their sizes (number of triples or bytes)
+    :return: tuple (list of batches, list of graphs larger than max_size, which are not batched)
+    """
+    batches = []
+    large = []
+    batch = []
+    batch_size = 0
+    for graph in graphs:
+        size = sizes[graph]
+        if size > max_size:
+            large.append(graph)
+            continue
+        if batch and (batch_size + size > max_size or len(batch) >= max_graphs):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(graph)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches, large
+
+
+def graph_term(graph):
+    """
+    :return: SPARQL and N-Quads term of the graph name
+    """
+    return rdflib.URIRef(graph).n3()
+
+
+# Characters escaped in N-Triples string literals
+NTRIPLES_ESCAPES = {ord('\\'): '\\\\', ord('"'): '\\"', ord('\n'): '\\n', ord('\r'): '\\r'}
+
+
+def ntriples_term(term):
+    """
+    :return: N-Triples form of an rdflib term, Literal.n3() writes multi-line strings in Turtle long form
+    """
+    if not isinstance(term, rdflib.Literal):
+        return term.n3()
+    value = '"%s"' % str(term).translate(NTRIPLES_ESCAPES)
+    if term.language:
+        return value + '@' + term.language
+    if term.datatype:
+        return value + '^^' + term.datatype.n3()
+    return value
+
+
+def ntriples_row(statement):
+    """
+    :return: N-Triples line of statement (s, p, o)
+    """
+    return '%s %s %s .\n' % tuple(ntriples_term(term) for term in statement)
+
+
+def nquads_suffix(graph):
+    """
+    :return: end of the N-Quads statements of graph (bytes), statements of the default graph have no graph term
+    """
+    if graph == 'default':
+        return b' .\n'
+    return (' %s .\n' % graph_term(graph)).encode('utf-8')
+
+
+def to_nquad(line, suffix):
+    """
+    :return: stripped N-Triples statement line with its final '.' replaced by suffix
+    """
+    return line[:-1].rstrip() + suffix
+
+
+def result_term(value):
+    """
+    :return: rdflib term of a value in SPARQL JSON results
+    """
+    kind = value['type']
+    if kind == 'uri':
+        return rdflib.URIRef(value['value'])
+    if kind == 'bnode':
+        return rdflib.BNode(value['value'])
+    # Lexical forms are kept as they are
+    return rdflib.Literal(value['value'], lang=value.get('xml:lang'), datatype=value.get('datatype'), normalize=False)
+
+
+def to_ntriples(data, format="turtle"):
+    """
+    :return: graph serialized in data converted to N-Triples (bytes)
+    """
+    with timed('parse'):
+        graph = rdflib.Graph()
+        graph.parse(data=data, format=format)
+        return graph.serialize(format='nt', encoding='utf-8')
+
+
+class BatchTask(object):
+    """
+    Loads several graphs into a dataset with a single request. With method update each graph
+    is replaced by a DROP SILENT GRAPH and INSERT DATA operation of one SPARQL Update request
+    sent to dataset_url/update. With method quads the graphs are posted as N-Quads to the
+    dataset, which adds them to existing graphs, so it is meant for loading empty datasets.
+    When the server rejects a batch with a client error, the batch is split in halves which
+    are sent separately, so that a bad graph only fails itself. Such graphs are collected in
+    failed_graphs, the task still succeeds. Subclasses implement fetch() (and fetch_async()
+    for the async engine) returning N-Triples of the graphs.
+    """
+
+    def __init__(self, dataset_url, graphs, session, verify=False, method='update', endpoints=(), size=None):
+        self.dataset_url = dataset_url
+        self.graphs = list(graphs)
+        self.size = size  # total size of the graphs used for scheduling
+        self.session = session
+        self.verify = verify
+        self.method = method
+        # Name of the batch in progress and error messages
+        self.graph = self.graph_name = '%s (batch of %i graphs)' % (self.graphs[0], len(self.graphs))
+        self.endpoints = tuple(endpoints) + tuple(e for e in task_endpoints(dataset_url) if e not in endpoints)
+        self.pending = list(self.graphs)
+        self.failed_graphs = []  # list of (graph, exception)
+        self.data = {}  # graph -> N-Triples
+        self.finished = False
+
+    def fetch(self, graphs):
+        """
+        :return: dictionary mapping graphs to their content as N-Triples
+        """
+        raise NotImplementedError()
+
+    async def fetch_async(self, graphs):
+        raise NotImplementedError()
+
+    def request_args(self, graphs):
+        """
+        :return: tuple (url, headers, body) of the request loading graphs
+        """
+        if self.method == 'update':
+            operations = []
+            for graph in graphs:
+                name = graph_term(graph)
+                triples = self.data[graph].decode('utf-8')
+                if graph == 'default':
+                    operations.append('DROP SILENT DEFAULT ;\nINSERT DATA {\n%s}' % triples)
+                else:
+                    operations.append('DROP SILENT GRAPH %s ;\nINSERT DATA { GRAPH %s {\n%s} }' % (name, name, triples))
+            headers = {'content-type': 'application/sparql-update; charset=utf-8'}
+            return self.dataset_url + '/update', headers, ' ;\n'.join(operations).encode('utf-8')
+
+        chunks = []
+        for graph in graphs:
+            suffix = nquads_suffix(graph)
+            for line in self.data[graph].splitlines():
+                line = line.strip()
+                if line:
+                    chunks.append(to_nquad(line, suffix))
+        headers = {'content-type': 'application/n-quads'}
+        return self.dataset_url, headers, b''.join(chunks)
+
+    def loaded(self, graphs):
+        done = set(graphs)
+        self.pending = [g for g in self.pending if g not in done]
+
+    def rejected(self, graphs, exc):
+        """
+        :return: halves of graphs to be sent separately or None when the batch cannot be split
+        """
+        if is_retryable(exc):
+            return None
+        if len(graphs) == 1:
+            self.failed_graphs.append((graphs[0], exc))
+            self.loaded(graphs)
+            return []
+        half = len(graphs) // 2
+        return [graphs[:half], graphs[half:]]
+
+    def load(self, graphs):
+        url, headers, body = self.request_args(graphs)
+        try:
+            response = self.session.request("POST", url, headers=headers, verify=self.verify, data=body)
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            parts = self.rejected(graphs, e)
+            if parts is None:
+                raise
+            for part in parts:
+                self.load(part)
+            return
+        self.loaded(graphs)
+
+    async def load_async(self, graphs):
+        url, headers, body = self.request_args(graphs)
+        try:
+            response = await self.session.request("POST", url, headers=headers, verify=self.verify, data=body)
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            parts = self.rejected(graphs, e)
+            if parts is None:
+                raise
+            for part in parts:
+                await self.load_async(part)
+            return
+        self.loaded(graphs)
+
+    def run(self):
+        if self.finished:
+            return self
+        missing = [g for g in self.pending if g not in self.data]
+        if missing:
+            self.data.update(self.fetch(missing))
+        self.load(list(self.pending))
+        self.data = {}
+        self.finished = True
+        return self
+
+    async def run_async(self):
+        if self.finished:
+            return self
+        missing = [g for g in self.pending if g not in self.data]
+        if missing:
+            self.data.update(await self.fetch_async(missing))
+        await self.load_async(list(self.pending))
+        self.data = {}
+        self.finished = True
+        return self
+
+
+def add_batch_arguments(parser, size_option):
+    """
+    Adds batching options to argparse parser, size_option is 'triples' or 'bytes'
+    depending on the sizes of graphs known to the tool.
+    """
+    parser.add_argument('--batch', action='store_true',
+                        help='load small graphs in batches with a single request per batch')
+    parser.add_argument('--batch-method', choices=BATCH_METHODS, default='update',
+                        help='load batches with a SPARQL Update replacing the graphs, or by posting N-Quads to the '
+                             'dataset, which adds to existing graphs')
+    parser.add_argument('--batch-graphs', metavar='N', type=int, default=DEFAULT_BATCH_GRAPHS,
+                        help='maximal number of graphs in a batch')
+    if size_option == 'triples':
+        parser.add_argument('--batch-triples', metavar='N', type=int, default=DEFAULT_BATCH_TRIPLES,
+                            help='maximal number of triples in a batch, larger graphs are loaded separately')
+    else:
+        parser.add_argument('--batch-bytes', metavar='BYTES', type=int, default=DEFAULT_BATCH_BYTES,
+                            help='maximal size of graph files in a batch, larger graphs are loaded separately')
@@ -1,28 +1,24 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # vim: set fileencoding=utf8 :
 
-from __future__ import print_function
-
+import asyncio
+import os
 import sys
 import warnings
 
-import rdflib
-from rdfutils import calc_hash_value
-import hashlib
-import concurrent.futures
-import requests
-from SPARQLWrapper import SPARQLWrapper, JSON
-from concurrent.futures import ThreadPoolExecutor
-from six.moves.urllib.parse import urlencode
+from httputils import add_transport_arguments, create_session_from_args
+from taskutils import add_scheduler_arguments, create_scheduler_from_args, positive_int, task_endpoints
+from graphutils import add_listing_arguments, create_lister_from_args
+from metricsutils import ProgressBar, add_metrics_arguments, create_metrics_from_args
+from hashutils import CPU_COUNT, HashStage, add_hash_arguments, write_temp_file, write_temp_file_async
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlencode
 import argparse
 
-MAX_WORKERS = 5
-try:
-    import multiprocessing
+MAX_WORKERS = CPU_COUNT * 5
 
-    MAX_WORKERS = multiprocessing.cpu_count() * 5
-except (ImportError, NotImplementedError):
-    pass
+# Size of chunks in which downloaded graphs are written to temporary files
+CHUNK_SIZE = 64 * 1024
 
 
 # https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
@@ -48,69 +44,115 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
-def progress(count, total, suffix=''):
-    bar_len = 60
-    filled_len = int(round(bar_len * count / float(total)))
-
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
-
-    sys.stdout.write('[%s] %s%s ...%s\r' % (bar, percents, '%', suffix))
-    sys.stdout.flush()  # As suggested by Rom Ruben
-
-
-def hash_graph(data, format, hash="sha256"):
-    graph = rdflib.Graph()
-    graph.parse(data=data, format=format)
-    rdf_hash = calc_hash_value(graph)
-    if hash != 'none':
-        hash_func = hashlib.new(hash)
-        hash_func.update(rdf_hash.encode('utf-8'))
-        rdf_hash = hash_func.hexdigest()
-    return rdf_hash
+# Rate-limited, not drawn when stdout is not a terminal
+progress = ProgressBar()
 
 
 class CompareTask(object):
+    get_headers = {
+        'accept': "text/turtle",
+        'cache-control': "no-cache"
+    }
 
-    def __init__(self, url1, url2, graph, verify=False):
+    def __init__(self, url1, url2, graph, hash_stage, session, verify=False, tmp_dir=None, size=None):
         self.url1 = url1
         self.url2 = url2
         self.graph = graph
+        self.size = size  # number of triples used for scheduling
+        self.hash_stage = hash_stage
+        self.session = session
         self.verify = verify
+        self.tmp_dir = tmp_dir
         query = {'graph': graph}
         ue_query = urlencode(query)
         self.get_url1 = url1 + '?' + ue_query
         self.get_url2 = url2 + '?' + ue_query
-        self.data1 = None
-        self.data2 = None
+        self.endpoints = task_endpoints(url1, url2)
         self.finished = False
         self.hash1 = None
         self.hash2 = None
+        # Futures of hashes being computed, kept when the task fails so that a retry reuses them
+        self.future1 = None
+        self.future2 = None
+
+    def fetch(self, url):
+        """
+        Streams the graph to a temporary file, so that the data is never held in memory.
+        :return: name of the temporary file
+        """
+        response = self.session.request("GET", url, headers=self.get_headers, verify=self.verify, stream=True)
+        try:
+            response.raise_for_status()
+            return write_temp_file(response.iter_content(CHUNK_SIZE), self.tmp_dir)
+        finally:
+            response.close()
 
     def run(self):
         if self.finished:
             return self
 
-        get_headers = {
-            'accept': "text/turtle",
-            'cache-control': "no-cache"
-        }
+        # Both graphs are fetched before waiting for their hashes
+        if self.hash1 is None and self.future1 is None:
+            self.future1 = self.hash_stage.submit(self.fetch(self.get_url1), "turtle", self.graph)
 
-        if self.data1 is None:
-            response = requests.request("GET", self.get_url1, headers=get_headers, verify=self.verify)
-            response.raise_for_status()
-            self.data1 = response.content
-            self.hash1 = hash_graph(self.data1, format="turtle")
+        if self.hash2 is None and self.future2 is None:
+            self.future2 = self.hash_stage.submit(self.fetch(self.get_url2), "turtle", self.graph)
+
+        # A failed hash is computed again by the next trial
+        if self.future1 is not None:
+            future1, self.future1 = self.future1, None
+            self.hash1 = future1.result()[0]
+        if self.future2 is not None:
+            future2, self.future2 = self.future2, None
+            self.hash2 = future2.result()[0]
 
         assert self.hash1 is not None
+        assert self.hash2 is not None
+
+        self.finished = True
+        return self
 
-        if self.data2 is None:
-            response = requests.request("GET", self.get_url2, headers=get_headers, verify=self.verify)
+    async def fetch_async(self, url):
+        """
+        Coroutine version of fetch() for the async engine.
+        :return: name of the temporary file
+        """
+        response = await self.session.request("GET", url, headers=self.get_headers, verify=self.verify,
+                                              stream=True)
+        try:
             response.raise_for_status()
-            self.data2 = response.content
-            self.hash2 = hash_graph(self.data2, format="turtle")
+            return await write_temp_file_async(response.aiter_content(CHUNK_SIZE), self.tmp_dir)
+        finally:
+            await response.aclose()
+
+    async def hash_async(self, url):
+        file_name = await self.fetch_async(url)
+        # HashStage.submit blocks while the hash queue is full, so it must not run on the event loop
+        loop = asyncio.get_event_loop()
+        future = await loop.run_in_executor(None, self.hash_stage.submit, file_name, "turtle",
+                                            self.graph)
+        return (await asyncio.wrap_future(future))[0]
+
+    async def run_async(self):
+        """
+        Coroutine version of run() for the async engine, session must be an asyncutils.AsyncSession.
+        """
+        if self.finished:
+            return self
 
-        assert self.hash2 is not None
+        async def hash1():
+            if self.hash1 is None:
+                self.hash1 = await self.hash_async(self.get_url1)
+
+        async def hash2():
+            if self.hash2 is None:
+                self.hash2 = await self.hash_async(self.get_url2)
+
+        # Both graphs are fetched and hashed concurrently, the hash of one graph is kept when the other one fails
+        results = await asyncio.gather(hash1(), hash2(), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
 
         self.finished = True
         return self
@@ -126,74 +168,92 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument('--debug', help='debug mode', action="store_true")
+    add_transport_arguments(parser)
+    add_scheduler_arguments(parser, max_workers=None)
+    add_metrics_arguments(parser)
+    parser.add_argument('--fetch-workers', metavar='N', type=positive_int, default=MAX_WORKERS,
+                        help='number of threads downloading graphs')
+    add_hash_arguments(parser)
+    add_listing_arguments(parser)
+    parser.add_argument('--no-precheck', action='store_true',
+                        help='do not compare graph names and sizes before downloading graphs')
     parser.add_argument('url1', metavar='URL1', help='url of the first dataset')
     parser.add_argument('url2', metavar='URL2', help='url of the second dataset')
     args = parser.parse_args()
 
     src_url = args.url1
     dest_url = args.url2
+    metrics = create_metrics_from_args(args)
 
     print("Dataset 1:", src_url)
     print("Dataset 2:", dest_url)
 
-    print('Getting graph list from {} ...'.format(src_url))
-    src = SPARQLWrapper(src_url + '/sparql')
-    src.setQuery("""SELECT DISTINCT ?g
-    WHERE {
-      GRAPH ?g { ?s ?p ?o }
-    }""")
-    src.setReturnFormat(JSON)
-
-    qr = src.query().convert()
-    graphs = []
-    has_default = False
-    for result in qr["results"]["bindings"]:
-        g = result["g"]["value"]
-        graphs.append(g)
-        has_default = has_default or g == 'default'
-
-    if not has_default:
-        graphs.append('default')
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        l = len(graphs)
-
-        future_to_task = {}
-        for i, g in enumerate(graphs):
-            progress(i + 1, l, suffix='Prepare tasks')
-            task = CompareTask(src_url, dest_url, g, verify=False)
-            future = executor.submit(task.run)
-            future_to_task[future] = task
-
-        num_trials = 3
-        trial = 0
-
-        done_tasks = []
-        while future_to_task:
-            trial += 1
-            repeat_tasks = []
-            l = len(future_to_task)
-            j = 0
-            for future in concurrent.futures.as_completed(future_to_task):
-                task = future_to_task[future]
-                progress(j, l, suffix='Compare data [%i / %i] in graph %s        ' % (trial, num_trials, task.graph))
-                try:
-                    done_tasks.append(future.result())
-                except Exception as exc:
-                    print()
-                    print('comparison task for graph %s failed, exception: %s' % (task.graph, exc), file=sys.stderr)
-                    repeat_tasks.append(task)
+    # Graphs existing only in one dataset and graphs with different number of triples
+    only1 = []
+    only2 = []
+    size_diff = []
+
+    src_lister = create_lister_from_args(args, src_url)
+    sizes1 = {}
+    if args.no_precheck:
+        print('Getting graph list from {} ...'.format(src_url))
+        if args.order == 'largest':
+            sizes1 = src_lister.graph_sizes()
+            graphs = sorted(sizes1)
+            if 'default' not in graphs:
+                graphs.append('default')
+        else:
+            # Graphs are compared while they are listed
+            graphs = (g for g, size in src_lister.iter_graphs())
+    else:
+        print('Getting graph sizes from {} ...'.format(src_url))
+        sizes1 = src_lister.graph_sizes()
+        print('Getting graph sizes from {} ...'.format(dest_url))
+        sizes2 = create_lister_from_args(args, dest_url).graph_sizes()
+
+        only1 = sorted(g for g in sizes1 if g not in sizes2)
+        only2 = sorted(g for g in sizes2 if g not in sizes1)
+        # Only graphs of the same size need to be downloaded and hashed
+        graphs = []
+        for g in sorted(sizes1):
+            if g in sizes2:
+                if sizes1[g] == sizes2[g]:
+                    graphs.append(g)
                 else:
-                    # print('task success: %s' % (data,), file=sys.stderr) # DEBUG
-                    pass
-                j += 1
-            progress(j, l, suffix='Compare data [%i / %i] in graph %s        ' % (trial, num_trials, task.graph))
+                    size_diff.append((g, sizes1[g], sizes2[g]))
+        print('Graphs to compare by hash: {}, different sizes: {}, missing: {}'.format(
+            len(graphs), len(size_diff), len(only1) + len(only2)))
 
-            print()
+        # Size of the default graph depends on the server configuration, it is always compared by hash
+        if 'default' not in graphs:
+            graphs.append('default')
+
+    session = create_session_from_args(args, args.fetch_workers)
+    scheduler = create_scheduler_from_args(args, max_workers=args.fetch_workers)
+
+    def on_progress(count, total, task):
+        progress(count, total, suffix='Compare data in graph %s        ' % task.graph)
+
+    def on_error(task, exc, trial, retry):
+        print()
+        print('comparison task for graph %s failed [%i / %i], exception: %s'
+              % (task.graph, trial, scheduler.num_trials, exc), file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=args.hash_workers) as hash_executor:
+        hash_stage = HashStage(hash_executor, args.hash_workers, args.hash_queue)
+        tasks = (CompareTask(src_url, dest_url, g, hash_stage, session, verify=False, tmp_dir=args.tmp_dir,
+                             size=sizes1.get(g))
+                 for g in graphs)
+        if isinstance(graphs, list):
+            tasks = list(tasks)
+            progress(0, len(tasks), suffix='Compare data')
+        done_tasks, repeat_tasks = scheduler.run(tasks, on_progress=on_progress, on_error=on_error)
+        print()
 
-            future_to_task.clear()
-            if repeat_tasks and trial < num_trials:
-                future_to_task = {executor.submit(task.run): task for task in repeat_tasks}
+        if metrics is not None:
+            metrics.close()
+            for line in metrics.summary():
+                print(line)
 
         print()
         result = 0
@@ -205,7 +265,13 @@ def main():
         else:
             print('Successfuly compared all data')
         num_equal = 0
-        num_diff = 0
+        num_diff = len(size_diff)
+        for g, size1, size2 in size_diff:
+            print('Graph {} has different number of triples: {} != {}'.format(g, size1, size2), file=sys.stderr)
+        for g in only1:
+            print('Graph {} exists only in dataset 1'.format(g), file=sys.stderr)
+        for g in only2:
+            print('Graph {} exists only in dataset 2'.format(g), file=sys.stderr)
         for task in done_tasks:
             if task.hash1 == task.hash2:
                 num_equal += 1
@@ -216,6 +282,8 @@ def main():
 
         print('Equal graphs:', num_equal)
         print('Different graphs:', num_diff)
+        print('Graphs only in dataset 1:', len(only1))
+        print('Graphs only in dataset 2:', len(only2))
         return result
 
 
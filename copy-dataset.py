@@ -1,25 +1,30 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # vim: set fileencoding=utf8 :
 
-from __future__ import print_function
-
 import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
 import sys
 import warnings
 
-import concurrent.futures
-import requests
-from SPARQLWrapper import SPARQLWrapper, JSON
-from concurrent.futures import ThreadPoolExecutor
-from six.moves.urllib.parse import urlencode
+import rdflib
+from httputils import add_transport_arguments, create_session_from_args, is_length_required, content_length
+from httputils import FileBody, StreamBody, CHUNK_SIZE
+from taskutils import add_scheduler_arguments, create_scheduler_from_args, task_endpoints
+from manifestutils import GraphManifest, DEFAULT_CACHE_DIR
+from batchutils import BatchTask, add_batch_arguments, graph_term, make_batches, result_term
+from graphutils import add_listing_arguments, add_split_arguments, create_lister_from_args, GraphPages
+from graphutils import DEFAULT_SPLIT_PAGE_SIZE, DEFAULT_SPLIT_PARALLELISM, PAGE_CONTENT_TYPE
+from metricsutils import ProgressBar, add_metrics_arguments, create_metrics_from_args, in_context, timed
+from hashutils import HashStage, add_hash_arguments, write_temp_file, write_temp_file_async
+from fileutils import iter_file_range
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlencode
 
-MAX_WORKERS = 5
-try:
-    import multiprocessing
-
-    MAX_WORKERS = multiprocessing.cpu_count() * 5
-except (ImportError, NotImplementedError):
-    pass
+NOT_MODIFIED = 304
+NOT_FOUND = 404
 
 
 # https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
@@ -45,42 +50,264 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
-def progress(count, total, suffix=''):
-    bar_len = 60
-    filled_len = int(round(bar_len * count / float(total)))
-
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
-
-    sys.stdout.write('[%s] %s%s ...%s\r' % (bar, percents, '%', suffix))
-    sys.stdout.flush()  # As suggested by Rom Ruben
+# Rate-limited, not drawn when stdout is not a terminal
+progress = ProgressBar()
 
 
 class CopyTask(object):
-
-    def __init__(self, src_url, dest_url, graph, verify=False):
+    get_headers = {
+        'accept': "text/turtle",
+        'cache-control': "no-cache"
+    }
+
+    put_headers = {
+        'content-type': "text/turtle",
+        'cache-control': "no-cache"
+    }
+
+    page_put_headers = {
+        'content-type': PAGE_CONTENT_TYPE,
+        'cache-control': "no-cache"
+    }
+
+    def __init__(self, src_url, dest_url, graph, session, verify=False, stream=True, manifest=None,
+                 src_size=None, dest_size=None, split_size=None, page_size=DEFAULT_SPLIT_PAGE_SIZE,
+                 parallelism=DEFAULT_SPLIT_PARALLELISM, hash_stage=None, tmp_dir=None):
         self.src_url = src_url
         self.dest_url = dest_url
         self.graph = graph
+        self.session = session
         self.verify = verify
         query = {'graph': graph}
         ue_query = urlencode(query)
         self.get_url = src_url + '?' + ue_query
         self.put_url = dest_url + '?' + ue_query
+        self.endpoints = task_endpoints(src_url, dest_url)
+        # Without stream the graph is buffered, so that it is sent with Content-Length and kept for retries
+        self.stream = stream
+        # With manifest the graph is copied only when it differs from the destination, see run_changed().
+        # Graphs are downloaded to temporary files in tmp_dir and hashed by hash_stage (hashutils.HashStage).
+        # Sizes are numbers of triples, 0 for missing graphs and None when unknown.
+        self.manifest = manifest
+        self.hash_stage = hash_stage
+        self.tmp_dir = tmp_dir
+        self.src_size = src_size
+        self.dest_size = dest_size
+        self.size = src_size  # used for scheduling
+        # Graphs of at least split_size triples are fetched in pages, see copy_pages()
+        self.split_size = split_size
+        self.page_size = page_size
+        self.parallelism = parallelism
+        self.changed = None
+        if src_size is not None and dest_size is not None and src_size != dest_size:
+            self.changed = True
+        self.entry = None  # manifest entry of the source graph
         self.data = None
         self.finished = False
 
+    def copy_stream(self):
+        """
+        Pipes the body of the GET response into the body of the PUT request, so that the upload
+        starts with the first chunk and at most a few chunks of the graph are held in memory.
+        """
+        response = self.session.request("GET", self.get_url, headers=self.get_headers, verify=self.verify,
+                                        stream=True)
+        try:
+            response.raise_for_status()
+            put_response = self.session.request("PUT", self.put_url, headers=self.put_headers, verify=self.verify,
+                                                data=StreamBody(response))
+            put_response.raise_for_status()
+        finally:
+            response.close()
+
+    def create_pages(self):
+        """
+        :return: GraphPages fetching the source graph or None when it is fetched with a single GET
+        """
+        if self.split_size is None or self.size is None or self.size < self.split_size:
+            return None
+        return GraphPages(self.src_url, self.graph, self.session, verify=self.verify, page_size=self.page_size,
+                          parallelism=self.parallelism)
+
+    def copy_pages(self, pages):
+        """
+        Copies the graph fetched in pages, see graphutils.GraphPages. Pages are streamed into the
+        PUT request unless the graph is buffered. When the pages do not hold the graph exactly,
+        the graph is copied again with a single GET, whose PUT replaces the copy.
+        :return: True if the graph was copied, False if it must be copied with a single GET
+        """
+        if not pages.plan():
+            return False
+        if self.stream:
+            try:
+                response = self.session.request("PUT", self.put_url, headers=self.page_put_headers,
+                                                verify=self.verify, data=FileBody(pages.iter_ntriples))
+                response.raise_for_status()
+            except Exception as e:
+                if not is_length_required(e):
+                    raise
+                self.stream = False
+        if not self.stream:
+            response = self.session.request("PUT", self.put_url, headers=self.page_put_headers, verify=self.verify,
+                                            data=b''.join(pages.iter_ntriples()))
+            response.raise_for_status()
+        return self.complete_pages(pages)
+
+    async def copy_pages_async(self, pages):
+        """
+        Coroutine version of copy_pages() for the async engine.
+        """
+        if not await pages.plan_async():
+            return False
+        if self.stream:
+            try:
+                response = await self.session.request("PUT", self.put_url, headers=self.page_put_headers,
+                                                      verify=self.verify, data=pages.aiter_ntriples())
+                response.raise_for_status()
+            except Exception as e:
+                if not is_length_required(e):
+                    raise
+                self.stream = False
+        if not self.stream:
+            data = b''.join([chunk async for chunk in pages.aiter_ntriples()])
+            response = await self.session.request("PUT", self.put_url, headers=self.page_put_headers,
+                                                  verify=self.verify, data=data)
+            response.raise_for_status()
+        return self.complete_pages(pages)
+
+    def complete_pages(self, pages):
+        if not pages.is_complete():
+            self.split_size = None
+            return False
+        self.finished = True
+        return True
+
+    def recorded_entry(self):
+        """
+        :return: manifest entry of the last copy when the destination still has its size or None
+        """
+        entry = self.manifest.get(self.graph)
+        if entry is None or entry['hash'] is None:
+            return None
+        if self.dest_size is not None and entry['size'] != self.dest_size:
+            return None
+        return entry
+
+    def source_headers(self):
+        """
+        :return: headers of the source GET, conditional when the destination holds the last copy
+        """
+        headers = dict(self.get_headers)
+        entry = self.recorded_entry()
+        if self.changed is None and entry is not None and entry['etag']:
+            headers['if-none-match'] = entry['etag']
+        return headers
+
+    def set_source(self, headers, hash_value, size):
+        self.entry = {'hash': hash_value, 'size': size, 'etag': headers.get('etag'),
+                      'last_modified': headers.get('last-modified')}
+        if self.changed is None:
+            entry = self.recorded_entry()
+            if entry is not None:
+                self.changed = entry['hash'] != hash_value
+            elif self.dest_size is not None and self.dest_size != size:
+                self.changed = True
+
+    def finish_changed(self):
+        self.manifest.put(self.graph, **self.entry)
+        self.finished = True
+        return self
+
+    def file_body(self, file_name):
+        """
+        :return: FileBody streaming the downloaded graph in file file_name
+        """
+        length = os.path.getsize(file_name)
+        return FileBody(lambda: iter_file_range(file_name, 0, length), length)
+
+    def fetch_file(self, url, headers):
+        """
+        Streams the graph to a temporary file.
+        :return: tuple (response, name of the temporary file or None when the response has no graph)
+        """
+        response = self.session.request("GET", url, headers=headers, verify=self.verify, stream=True)
+        try:
+            if response.status_code in (NOT_MODIFIED, NOT_FOUND):
+                return response, None
+            response.raise_for_status()
+            return response, write_temp_file(response.iter_content(CHUNK_SIZE), self.tmp_dir)
+        finally:
+            response.close()
+
+    def dest_hash(self):
+        """
+        :return: hash of the destination graph or None when it does not exist
+        """
+        response, file_name = self.fetch_file(self.put_url, self.get_headers)
+        if file_name is None:
+            return None
+        return self.hash_stage.submit(file_name, "turtle", self.graph).result()[0]
+
+    def run_changed(self):
+        """
+        Copies the graph only when it differs from the destination. The source is fetched with
+        If-None-Match when the manifest records its ETag and the destination still has the size
+        of the last copy, a not modified graph is not transferred at all. Otherwise the hash of
+        the source is compared with the hash recorded in the manifest, or with the hash of the
+        destination graph when there is no valid record. Graphs are streamed to temporary files
+        and hashed in the process pool of the hash stage. When the sizes show that the graph
+        changed, it is uploaded while it is hashed for the manifest.
+        """
+        response, file_name = self.fetch_file(self.get_url, self.source_headers())
+        if file_name is None:
+            response.raise_for_status()  # The source graph must exist
+            self.changed = False
+            self.finished = True
+            return self
+        future = None
+        try:
+            future = self.hash_stage.submit(file_name, "turtle", self.graph, remove=False)
+            if self.changed is None:
+                self.set_source(response.headers, *future.result())
+            if self.changed is None:
+                self.changed = self.dest_hash() != self.entry['hash']
+            if self.changed:
+                put_response = self.session.request("PUT", self.put_url, headers=self.put_headers,
+                                                    verify=self.verify, data=self.file_body(file_name))
+                put_response.raise_for_status()
+            if self.entry is None:
+                self.set_source(response.headers, *future.result())
+        finally:
+            # The file may still be read by the hash stage
+            if future is not None:
+                concurrent.futures.wait([future])
+            os.remove(file_name)
+        return self.finish_changed()
+
     def run(self):
         if self.finished:
             return self
 
-        if self.data is None:
-            get_headers = {
-                'accept': "text/turtle",
-                'cache-control': "no-cache"
-            }
+        if self.manifest is not None:
+            return self.run_changed()
 
-            response = requests.request("GET", self.get_url, headers=get_headers, verify=self.verify)
+        pages = self.create_pages()
+        if pages is not None and self.copy_pages(pages):
+            return self
+
+        if self.stream:
+            try:
+                self.copy_stream()
+                self.finished = True
+                return self
+            except Exception as e:
+                if not is_length_required(e):
+                    raise
+                # The destination does not accept chunked bodies, buffer the graph instead
+                self.stream = False
+
+        if self.data is None:
+            response = self.session.request("GET", self.get_url, headers=self.get_headers, verify=self.verify)
             response.raise_for_status()
             self.data = response.content
 
@@ -91,22 +318,213 @@ class CopyTask(object):
             # print(response.text.encode('utf-8'), file=sys.stderr)
 
         # try:
-        #     response = requests.request("DELETE", put_url, verify=False)
+        #     response = self.session.request("DELETE", put_url, verify=False)
         #     response.raise_for_status()
         # except requests.HTTPError as e:
         #     pass
 
-        put_headers = {
-            'content-type': "text/turtle",
-            'cache-control': "no-cache"
+        response = self.session.request("PUT", self.put_url, headers=self.put_headers, verify=self.verify,
+                                        data=self.data)
+        response.raise_for_status()
+        self.finished = True
+        # print(get_url, put_url, file=sys.stderr)
+        return self
+
+    async def copy_stream_async(self):
+        """
+        Coroutine version of copy_stream() for the async engine.
+        """
+        response = await self.session.request("GET", self.get_url, headers=self.get_headers, verify=self.verify,
+                                              stream=True)
+        try:
+            response.raise_for_status()
+            put_headers = dict(self.put_headers)
+            length = content_length(response)
+            if length is not None:
+                put_headers['content-length'] = str(length)
+            put_response = await self.session.request("PUT", self.put_url, headers=put_headers, verify=self.verify,
+                                                      data=response.aiter_content(CHUNK_SIZE))
+            put_response.raise_for_status()
+        finally:
+            await response.aclose()
+
+    async def fetch_file_async(self, url, headers):
+        """
+        Coroutine version of fetch_file() for the async engine.
+        """
+        response = await self.session.request("GET", url, headers=headers, verify=self.verify, stream=True)
+        try:
+            if response.status_code in (NOT_MODIFIED, NOT_FOUND):
+                return response, None
+            response.raise_for_status()
+            return response, await write_temp_file_async(response.aiter_content(CHUNK_SIZE), self.tmp_dir)
+        finally:
+            await response.aclose()
+
+    async def hash_file_async(self, file_name, remove=True):
+        """
+        :return: future of tuple (hash, number of triples) of the graph in file file_name
+        """
+        # HashStage.submit blocks while the hash queue is full, so it must not run on the event loop
+        loop = asyncio.get_event_loop()
+        future = await loop.run_in_executor(None, in_context(self.hash_stage.submit), file_name, "turtle",
+                                            self.graph, remove)
+        return asyncio.wrap_future(future)
+
+    async def dest_hash_async(self):
+        """
+        Coroutine version of dest_hash() for the async engine.
+        """
+        response, file_name = await self.fetch_file_async(self.put_url, self.get_headers)
+        if file_name is None:
+            return None
+        return (await (await self.hash_file_async(file_name)))[0]
+
+    async def run_changed_async(self):
+        """
+        Coroutine version of run_changed() for the async engine.
+        """
+        response, file_name = await self.fetch_file_async(self.get_url, self.source_headers())
+        if file_name is None:
+            response.raise_for_status()  # The source graph must exist
+            self.changed = False
+            self.finished = True
+            return self
+        future = None
+        try:
+            future = await self.hash_file_async(file_name, remove=False)
+            if self.changed is None:
+                self.set_source(response.headers, *(await future))
+            if self.changed is None:
+                self.changed = await self.dest_hash_async() != self.entry['hash']
+            if self.changed:
+                body = self.file_body(file_name)
+                headers = dict(self.put_headers)
+                headers['content-length'] = str(body.length)
+                put_response = await self.session.request("PUT", self.put_url, headers=headers, verify=self.verify,
+                                                          data=body.aiter())
+                put_response.raise_for_status()
+            if self.entry is None:
+                self.set_source(response.headers, *(await future))
+        finally:
+            # The file may still be read by the hash stage
+            if future is not None:
+                await asyncio.wait([future])
+            os.remove(file_name)
+        return self.finish_changed()
+
+    async def run_async(self):
+        """
+        Coroutine version of run() for the async engine, session must be an asyncutils.AsyncSession.
+        """
+        if self.finished:
+            return self
+
+        if self.manifest is not None:
+            return await self.run_changed_async()
+
+        pages = self.create_pages()
+        if pages is not None and await self.copy_pages_async(pages):
+            return self
+
+        if self.stream:
+            try:
+                await self.copy_stream_async()
+                self.finished = True
+                return self
+            except Exception as e:
+                if not is_length_required(e):
+                    raise
+                self.stream = False
+
+        if self.data is None:
+            response = await self.session.request("GET", self.get_url, headers=self.get_headers, verify=self.verify)
+            response.raise_for_status()
+            self.data = response.content
+
+        response = await self.session.request("PUT", self.put_url, headers=self.put_headers, verify=self.verify,
+                                              data=self.data)
+        response.raise_for_status()
+        self.finished = True
+        return self
+
+
+class CopyBatchTask(BatchTask):
+    """
+    Copies a batch of small graphs, which are read from the source with a single query.
+    """
+
+    def __init__(self, src_url, dest_url, graphs, session, verify=False, method='update', size=None):
+        super(CopyBatchTask, self).__init__(dest_url, graphs, session, verify=verify, method=method,
+                                            endpoints=task_endpoints(src_url), size=size)
+        self.src_url = src_url
+
+    def query_args(self, graphs):
+        query = 'SELECT ?g ?s ?p ?o WHERE { VALUES ?g { %s } GRAPH ?g { ?s ?p ?o } }' % (
+            ' '.join(graph_term(g) for g in graphs))
+        headers = {
+            'accept': 'application/sparql-results+json',
+            'content-type': 'application/x-www-form-urlencoded'
         }
+        return self.src_url + '/sparql', headers, urlencode({'query': query})
+
+    @staticmethod
+    def parse_results(graphs, content):
+        with timed('parse'):
+            results = json.loads(content.decode('utf-8'))
+            data = dict((g, rdflib.Graph()) for g in graphs)
+            for result in results["results"]["bindings"]:
+                data[result["g"]["value"]].add((result_term(result["s"]), result_term(result["p"]),
+                                                result_term(result["o"])))
+            return dict((g, graph.serialize(format='nt', encoding='utf-8')) for g, graph in data.items())
+
+    def fetch(self, graphs):
+        url, headers, body = self.query_args(graphs)
+        response = self.session.request("POST", url, headers=headers, verify=self.verify, data=body)
+        response.raise_for_status()
+        return self.parse_results(graphs, response.content)
 
-        response = requests.request("PUT", self.put_url, headers=put_headers, verify=self.verify, data=self.data)
+    async def fetch_async(self, graphs):
+        url, headers, body = self.query_args(graphs)
+        response = await self.session.request("POST", url, headers=headers, verify=self.verify, data=body)
         response.raise_for_status()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, in_context(self.parse_results), graphs, response.content)
+
+
+class DeleteTask(object):
+    """
+    Deletes a graph which does not exist in the source dataset from the destination dataset.
+    """
+
+    def __init__(self, dest_url, graph, session, verify=False, manifest=None):
+        self.dest_url = dest_url
+        self.graph = graph
+        self.session = session
+        self.verify = verify
+        self.manifest = manifest
+        self.delete_url = dest_url + '?' + urlencode({'graph': graph})
+        self.endpoints = task_endpoints(dest_url)
+        self.finished = False
+
+    def check_response(self, response):
+        if response.status_code != NOT_FOUND:
+            response.raise_for_status()
+        if self.manifest is not None:
+            self.manifest.remove(self.graph)
         self.finished = True
-        # print(get_url, put_url, file=sys.stderr)
         return self
 
+    def run(self):
+        if self.finished:
+            return self
+        return self.check_response(self.session.request("DELETE", self.delete_url, verify=self.verify))
+
+    async def run_async(self):
+        if self.finished:
+            return self
+        return self.check_response(await self.session.request("DELETE", self.delete_url, verify=self.verify))
+
 
 def main():
     import ssl
@@ -119,85 +537,151 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument('--debug', help='debug mode', action="store_true")
+    add_transport_arguments(parser)
+    add_scheduler_arguments(parser)
+    parser.add_argument('--buffer', action='store_true',
+                        help='download each graph completely before uploading it with Content-Length, '
+                             'instead of streaming it from the source to the destination')
+    parser.add_argument('--changed-only', action='store_true',
+                        help='copy only graphs missing in the destination or differing from it, hashes of '
+                             'copied graphs are recorded in the manifest')
+    parser.add_argument('--delete', action='store_true',
+                        help='delete graphs which do not exist in the source from the destination')
+    parser.add_argument('--manifest', metavar='FILE', default=os.path.join(DEFAULT_CACHE_DIR, 'copy-manifest.sqlite'),
+                        help='manifest of copied graphs used by --changed-only')
+    add_hash_arguments(parser)
+    add_batch_arguments(parser, 'triples')
+    add_listing_arguments(parser)
+    add_split_arguments(parser)
+    add_metrics_arguments(parser)
     parser.add_argument('src_url', help='url of the source dataset')
     parser.add_argument('dest_url', help='url of the destination dataset')
     args = parser.parse_args()
+    if args.batch and args.changed_only:
+        parser.error('--batch cannot be combined with --changed-only')
 
     src_url = args.src_url
     dest_url = args.dest_url
+    metrics = create_metrics_from_args(args)
 
     print("Source dataset:", src_url)
     print("Destination dataset:", dest_url)
 
-    print('Getting graph list from {} ...'.format(src_url))
-    src = SPARQLWrapper(src_url + '/sparql')
-    src.setQuery("""SELECT DISTINCT ?g
-    WHERE {
-      GRAPH ?g { ?s ?p ?o }
-    }""")
-    src.setReturnFormat(JSON)
-
-    qr = src.query().convert()
-    graphs = []
-    has_default = False
-    for result in qr["results"]["bindings"]:
-        g = result["g"]["value"]
-        graphs.append(g)
-        has_default = has_default or g == 'default'
-
-    if not has_default:
-        graphs.append('default')
-
-    # get graphs
-    l = len(graphs)
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-
-        progress(0, l, suffix='Prepare tasks')
-        future_to_task = {}
-        for i, g in enumerate(graphs):
-            task = CopyTask(src_url, dest_url, g, verify=False)
-            future = executor.submit(task.run)
-            future_to_task[future] = task
-            progress(i + 1, l, suffix='Prepare tasks')
-
-        num_trials = 3
-        trial = 0
-
-        while future_to_task:
-            trial += 1
-            repeat_tasks = []
-            l = len(future_to_task)
-            j = 0
-            for future in concurrent.futures.as_completed(future_to_task):
-                task = future_to_task[future]
-                progress(j, l, suffix='Copy data [%i / %i] in graph %s        ' % (trial, num_trials, task.graph))
-                try:
-                    future.result()
-                except Exception as exc:
-                    print()
-                    print('copy task for graph %s failed, exception: %s' % (task.graph, exc), file=sys.stderr)
-                    repeat_tasks.append(task)
-                else:
-                    # print('task success: %s' % (data,), file=sys.stderr) # DEBUG
-                    pass
-                j += 1
-
-            print()
-
-            future_to_task.clear()
-            if repeat_tasks and trial < num_trials:
-                future_to_task = {executor.submit(task.run): task for task in repeat_tasks}
-
+    src_sizes = None
+    dest_sizes = None
+    graphs = None
+    src_lister = create_lister_from_args(args, src_url)
+    if args.changed_only or args.delete or args.batch:
+        print('Getting graph sizes from {} ...'.format(src_url))
+        src_sizes = src_lister.graph_sizes()
+        if args.changed_only or args.delete:
+            print('Getting graph sizes from {} ...'.format(dest_url))
+            dest_sizes = create_lister_from_args(args, dest_url).graph_sizes()
+        graphs = sorted(src_sizes)
+        if 'default' not in src_sizes:
+            graphs.append('default')
+    else:
+        # Unless largest graphs are copied first, graphs are copied while they are listed
+        print('Getting graph list from {} ...'.format(src_url))
+
+    session = create_session_from_args(args, args.max_workers)
+    scheduler = create_scheduler_from_args(args)
+
+    def on_progress(count, total, task):
+        progress(count, total, suffix='Copy data in graph %s        ' % task.graph)
+
+    def on_error(task, exc, trial, retry):
         print()
-        if repeat_tasks:
-            print('Could not copy data for following graphs:', file=sys.stderr)
-            for task in repeat_tasks:
-                print(task.graph, file=sys.stderr)
-            return 1
+        print('copy task for graph %s failed [%i / %i], exception: %s'
+              % (task.graph, trial, scheduler.num_trials, exc), file=sys.stderr)
+
+    split_args = dict(split_size=args.split_size, page_size=args.split_page_size, parallelism=args.split_parallelism)
+    manifest = None
+    hash_executor = None
+    if args.changed_only:
+        manifest = GraphManifest(args.manifest, scope=src_url + ' ' + dest_url)
+        hash_executor = ProcessPoolExecutor(max_workers=args.hash_workers)
+        hash_stage = HashStage(hash_executor, args.hash_workers, args.hash_queue)
+        # Size of the default graph depends on the server configuration, it is always compared by hash
+        tasks = [CopyTask(src_url, dest_url, g, session, verify=False, manifest=manifest,
+                          src_size=None if g == 'default' else src_sizes.get(g, 0),
+                          dest_size=None if g == 'default' else dest_sizes.get(g, 0),
+                          hash_stage=hash_stage, tmp_dir=args.tmp_dir)
+                 for g in graphs]
+    elif args.batch:
+        # The default graph cannot be selected by the batch query, it is copied separately
+        batches, large = make_batches([g for g in graphs if g != 'default'], src_sizes, args.batch_triples,
+                                      args.batch_graphs)
+        tasks = [CopyBatchTask(src_url, dest_url, batch, session, verify=False, method=args.batch_method,
+                               size=sum(src_sizes[g] for g in batch))
+                 for batch in batches]
+        tasks.extend(CopyTask(src_url, dest_url, g, session, verify=False, stream=not args.buffer,
+                              src_size=src_sizes.get(g), **split_args)
+                     for g in large + ['default'])
+        print('Copying {} graphs in {} batches and {} graphs separately'.format(
+            sum(len(batch) for batch in batches), len(batches), len(large) + 1))
+    else:
+        # Largest graphs first requires sizes of all graphs
+        largest_first = args.order == 'largest'
+        if graphs is not None:
+            # Graphs were already listed with their sizes for --delete
+            listed = ((g, src_sizes.get(g)) for g in graphs)
+        else:
+            listed = src_lister.iter_graphs(sizes=largest_first or args.split_size is not None)
+        tasks = (CopyTask(src_url, dest_url, g, session, verify=False, stream=not args.buffer, src_size=size,
+                          **split_args)
+                 for g, size in listed)
+        if largest_first or graphs is not None:
+            tasks = list(tasks)
+    if args.delete:
+        tasks = list(tasks)
+        tasks.extend(DeleteTask(dest_url, g, session, verify=False, manifest=manifest)
+                     for g in sorted(dest_sizes) if g not in src_sizes and g != 'default')
+    if isinstance(tasks, list):
+        progress(0, len(tasks), suffix='Copy data')
+    try:
+        done_tasks, failed_tasks = scheduler.run(tasks, on_progress=on_progress, on_error=on_error)
+    finally:
+        if hash_executor is not None:
+            hash_executor.shutdown()
+    print()
+
+    if metrics is not None:
+        metrics.close()
+        for line in metrics.summary():
+            print(line)
+
+    if manifest is not None:
+        manifest.close()
+
+    print()
+    copied = [task for task in done_tasks if isinstance(task, CopyTask) and task.changed is not False]
+    deleted = [task for task in done_tasks if isinstance(task, DeleteTask)]
+    if args.changed_only:
+        print('Copied graphs:', len(copied))
+        print('Unchanged graphs:', len(done_tasks) - len(copied) - len(deleted))
+    if args.delete:
+        print('Deleted graphs:', len(deleted))
+    failed_graphs = []
+    for task in done_tasks:
+        if isinstance(task, BatchTask):
+            for g, exc in task.failed_graphs:
+                print('copy of graph %s was rejected, exception: %s' % (g, exc), file=sys.stderr)
+                failed_graphs.append(g)
+    for task in failed_tasks:
+        if isinstance(task, BatchTask):
+            failed_graphs.extend(g for g, exc in task.failed_graphs)
+            failed_graphs.extend(task.pending)
         else:
-            print('Successfuly copied all data')
-            return 0
+            failed_graphs.append(task.graph)
+    if failed_graphs:
+        print('Could not copy data for following graphs:', file=sys.stderr)
+        for g in failed_graphs:
+            print(g, file=sys.stderr)
+        return 1
+    else:
+        print('Successfuly copied all data')
+        return 0
 
 
 if __name__ == '__main__':
@@ -1,28 +1,25 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # vim: set fileencoding=utf8 :
 
-from __future__ import print_function
-
 import argparse
+import hashlib
 import sys
+import tempfile
 import warnings
 
-import concurrent.futures
-import requests
-from SPARQLWrapper import SPARQLWrapper, JSON
-from concurrent.futures import ThreadPoolExecutor
-from six.moves.urllib.parse import urlencode
-from six.moves.urllib.parse import quote_plus
+from httputils import add_transport_arguments, create_session_from_args, CHUNK_SIZE
+from taskutils import add_scheduler_arguments, create_scheduler_from_args, task_endpoints
+from manifestutils import GraphManifest, DIRECTORY_MANIFEST, PARTIAL_PREFIX
+from fileutils import COMPRESSIONS, compressing_writer, compression_suffix
+from archiveutils import GraphArchive, NTRIPLES_TYPES
+from graphutils import add_listing_arguments, add_split_arguments, create_lister_from_args, GraphPages
+from graphutils import DEFAULT_SPLIT_PAGE_SIZE, DEFAULT_SPLIT_PARALLELISM, PAGE_CONTENT_TYPE
+from metricsutils import ProgressBar, add_metrics_arguments, create_metrics_from_args
+from urllib.parse import quote_plus, urlencode
 import os
 import os.path
 
-MAX_WORKERS = 5
-try:
-    import multiprocessing
-
-    MAX_WORKERS = multiprocessing.cpu_count() * 5
-except (ImportError, NotImplementedError):
-    pass
+NOT_MODIFIED = 304
 
 
 # https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
@@ -48,47 +45,303 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
-def progress(count, total, suffix=''):
-    bar_len = 60
-    filled_len = int(round(bar_len * count / float(total)))
+# Rate-limited, not drawn when stdout is not a terminal
+progress = ProgressBar()
+
+
+class PartialFile(object):
+    """
+    Temporary file in the destination directory receiving a downloaded graph, compressed with
+    compression unless it is None. Size and SHA-256 digest of the stored bytes are computed
+    while writing. The file is moved to its final name only when it is complete, so that
+    interrupted downloads never leave partial graph files.
+    """
+
+    def __init__(self, dest_dir, compression=None):
+        self.fd = tempfile.NamedTemporaryFile(prefix=PARTIAL_PREFIX, dir=dest_dir, delete=False)
+        self.name = self.fd.name
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.compression = compression
+        # Created by the first write, compressors write their header immediately
+        self.compressor = None
+
+    def write_raw(self, chunk):
+        """
+        Writes chunk of already compressed data.
+        """
+        self.fd.write(chunk)
+        self.digest.update(chunk)
+        self.size += len(chunk)
+
+    def write(self, chunk):
+        if self.compression is None:
+            self.write_raw(chunk)
+            return
+        if self.compressor is None:
+            self.compressor = compressing_writer(_RawWriter(self.write_raw), self.compression)
+        self.compressor.write(chunk)
+
+    def commit(self, dest_file):
+        if self.compressor is not None:
+            self.compressor.close()
+        self.fd.close()
+        os.replace(self.name, dest_file)
+
+    def discard(self):
+        self.fd.close()
+        os.remove(self.name)
+
+
+class _RawWriter(object):
+    """
+    File object passing data written by a compressor to function write.
+    """
 
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
+    def __init__(self, write):
+        self.write = write
 
-    sys.stdout.write('[%s] %s%s ...%s\r' % (bar, percents, '%', suffix))
-    sys.stdout.flush()  # As suggested by Rom Ruben
+    def flush(self):
+        pass
 
 
 class DownloadTask(object):
-
-    def __init__(self, dataset_url, dest_dir, graph, verify=False):
+    get_headers = {
+        'accept': "text/turtle",
+        'cache-control': "no-cache"
+    }
+
+    def __init__(self, dataset_url, dest_dir, graph, session, verify=False, manifest=None, refresh=False,
+                 compression=None, size=None, split_size=None, page_size=DEFAULT_SPLIT_PAGE_SIZE,
+                 parallelism=DEFAULT_SPLIT_PARALLELISM):
         self.dataset_url = dataset_url
+        self.size = size  # number of triples used for scheduling
+        # Graphs of at least split_size triples are fetched in pages, see fetch_pages()
+        self.split_size = split_size
+        self.page_size = page_size
+        self.parallelism = parallelism
         self.dest_dir = dest_dir
-        self.dest_file = os.path.join(dest_dir, quote_plus(graph))
+        self.compression = compression
+        self.file_name = quote_plus(graph) + compression_suffix(compression)
+        self.dest_file = os.path.join(dest_dir, self.file_name)
         self.graph = graph
+        self.session = session
         self.verify = verify
         query = {'graph': graph}
         ue_query = urlencode(query)
         self.get_url = dataset_url + '?' + ue_query
-        self.data = None
+        self.endpoints = task_endpoints(dataset_url)
+        # Graphs completely downloaded according to the manifest are skipped,
+        # with refresh they are downloaded again when they were modified
+        self.manifest = manifest
+        self.refresh = refresh
+        self.skipped = False
         self.finished = False
 
+    def completed_entry(self):
+        """
+        :return: manifest entry of the graph when its file is complete or None
+        """
+        if self.manifest is None:
+            return None
+        entry = self.manifest.get(self.graph)
+        if entry is None or entry['file'] != self.file_name:
+            return None
+        try:
+            size = os.path.getsize(self.dest_file)
+        except OSError:
+            return None
+        if size != entry['size']:
+            return None
+        return entry
+
+    def request_headers(self, entry):
+        """
+        :return: headers of the GET request, conditional when the graph was downloaded before
+        """
+        headers = dict(self.get_headers)
+        if entry is not None:
+            if entry['etag']:
+                headers['if-none-match'] = entry['etag']
+            elif entry['last_modified']:
+                headers['if-modified-since'] = entry['last_modified']
+        return headers
+
+    def skip(self):
+        self.skipped = True
+        self.finished = True
+        return self
+
+    def is_raw(self, response):
+        """
+        :return: True if the gzip encoded body of response can be stored as it is
+        """
+        return self.compression == 'gzip' and response.headers.get('content-encoding', '').lower() == 'gzip'
+
+    def create_output(self, content_type):
+        """
+        :return: object receiving the graph in content_type with methods write(), write_raw() and discard()
+        """
+        return PartialFile(self.dest_dir, self.compression)
+
+    def complete(self, partial, headers):
+        partial.commit(self.dest_file)
+        if self.manifest is not None:
+            # Remove the file of the graph written before with another compression
+            entry = self.manifest.get(self.graph)
+            if entry is not None and entry['file'] and entry['file'] != self.file_name:
+                old_file = os.path.join(self.dest_dir, entry['file'])
+                if os.path.isfile(old_file):
+                    os.remove(old_file)
+            self.manifest.put(self.graph, file=self.file_name, size=partial.size, hash=partial.digest.hexdigest(),
+                              etag=headers.get('etag'), last_modified=headers.get('last-modified'))
+        self.finished = True
+        return self
+
+    def create_pages(self, entry):
+        """
+        :return: GraphPages fetching the graph or None when it is downloaded with a single GET
+        """
+        # Graphs downloaded before are checked with a conditional GET
+        if entry is not None or self.split_size is None or self.size is None or self.size < self.split_size:
+            return None
+        return GraphPages(self.dataset_url, self.graph, self.session, verify=self.verify, page_size=self.page_size,
+                          parallelism=self.parallelism)
+
+    def fetch_pages(self, pages):
+        """
+        Downloads the graph in pages, see graphutils.GraphPages.
+        :return: True if the graph is complete, False if it must be downloaded with a single GET
+        """
+        if not pages.plan():
+            return False
+        partial = self.create_output(PAGE_CONTENT_TYPE)
+        try:
+            for chunk in pages.iter_ntriples():
+                partial.write(chunk)
+        except BaseException:
+            partial.discard()
+            raise
+        return self.complete_pages(pages, partial)
+
+    async def fetch_pages_async(self, pages):
+        if not await pages.plan_async():
+            return False
+        partial = self.create_output(PAGE_CONTENT_TYPE)
+        try:
+            async for chunk in pages.aiter_ntriples():
+                partial.write(chunk)
+        except BaseException:
+            partial.discard()
+            raise
+        return self.complete_pages(pages, partial)
+
+    def complete_pages(self, pages, partial):
+        if not pages.is_complete():
+            partial.discard()
+            self.split_size = None
+            return False
+        self.complete(partial, {})
+        return True
+
     def run(self):
         if self.finished:
             return self
 
-        if self.data is None:
-            get_headers = {
-                'accept': "text/turtle",
-                'cache-control': "no-cache"
-            }
+        entry = self.completed_entry()
+        if entry is not None and not self.refresh:
+            return self.skip()
+
+        pages = self.create_pages(entry)
+        if pages is not None and self.fetch_pages(pages):
+            return self
 
-            response = requests.request("GET", self.get_url, headers=get_headers, verify=self.verify)
+        response = self.session.request("GET", self.get_url, headers=self.request_headers(entry), verify=self.verify,
+                                        stream=True)
+        try:
+            if response.status_code == NOT_MODIFIED:
+                return self.skip()
             response.raise_for_status()
-            self.data = response.content
+            partial = self.create_output(response.headers.get('content-type', ''))
+            try:
+                if self.is_raw(response):
+                    for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+                        partial.write_raw(chunk)
+                else:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        partial.write(chunk)
+                return self.complete(partial, response.headers)
+            except BaseException:
+                partial.discard()
+                raise
+        finally:
+            response.close()
+
+    async def run_async(self):
+        """
+        Coroutine version of run() for the async engine, session must be an asyncutils.AsyncSession.
+        """
+        if self.finished:
+            return self
+
+        entry = self.completed_entry()
+        if entry is not None and not self.refresh:
+            return self.skip()
 
-            with open(self.dest_file, 'wb') as fd:
-                fd.write(self.data)
+        pages = self.create_pages(entry)
+        if pages is not None and await self.fetch_pages_async(pages):
+            return self
+
+        response = await self.session.request("GET", self.get_url, headers=self.request_headers(entry),
+                                              verify=self.verify, stream=True)
+        try:
+            if response.status_code == NOT_MODIFIED:
+                return self.skip()
+            response.raise_for_status()
+            partial = self.create_output(response.headers.get('content-type', ''))
+            try:
+                if self.is_raw(response):
+                    async for chunk in response.aiter_raw(CHUNK_SIZE):
+                        partial.write_raw(chunk)
+                else:
+                    async for chunk in response.aiter_content(CHUNK_SIZE):
+                        partial.write(chunk)
+                return self.complete(partial, response.headers)
+            except BaseException:
+                partial.discard()
+                raise
+        finally:
+            await response.aclose()
+
+
+class ArchiveDownloadTask(DownloadTask):
+    """
+    Downloads a graph into an archiveutils.GraphArchive instead of a file of its own. Graphs are
+    requested as N-Triples, which are converted to N-Quads while they are received, responses in
+    other formats are converted when complete.
+    """
+    get_headers = {
+        'accept': "application/n-triples, text/turtle;q=0.5",
+        'cache-control': "no-cache"
+    }
+
+    def __init__(self, dataset_url, archive, graph, session, verify=False, refresh=False, size=None, **kwargs):
+        super(ArchiveDownloadTask, self).__init__(dataset_url, archive.directory, graph, session, verify=verify,
+                                                  refresh=refresh, size=size, **kwargs)
+        self.archive = archive
+
+    def completed_entry(self):
+        return self.archive.entry(self.graph)
+
+    def is_raw(self, response):
+        return False
+
+    def create_output(self, content_type):
+        content_type = content_type.split(';')[0].strip().lower()
+        return self.archive.writer(self.graph, None if content_type in NTRIPLES_TYPES else content_type or 'turtle')
+
+    def complete(self, writer, headers):
+        self.archive.add(self.graph, writer, etag=headers.get('etag'), last_modified=headers.get('last-modified'))
         self.finished = True
         return self
 
@@ -103,91 +356,110 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument('--debug', help='debug mode', action="store_true")
+    add_transport_arguments(parser)
+    add_scheduler_arguments(parser)
+    add_metrics_arguments(parser)
+    add_listing_arguments(parser)
+    add_split_arguments(parser)
+    parser.add_argument('--refresh', action='store_true',
+                        help='check graphs downloaded before with conditional requests and download them again '
+                             'when they were modified, instead of skipping them')
+    parser.add_argument('--compress', choices=sorted(COMPRESSIONS),
+                        help='compress graph files while they are downloaded, gzip encoded responses are stored '
+                             'without recompression')
+    parser.add_argument('--archive', action='store_true',
+                        help='store all graphs as N-Quads in the single file dest_dir with an index of graph offsets '
+                             'instead of a file per graph')
+    parser.add_argument('--shards', metavar='N', type=int, default=1,
+                        help='with --archive, distribute graphs over N files dest_dir, dest_dir.1, ...')
     parser.add_argument('url', help='url of the dataset')
-    parser.add_argument('dest_dir', help='destination directory')
+    parser.add_argument('dest_dir', help='destination directory, or archive file with --archive')
     args = parser.parse_args()
 
+    if args.archive and args.compress:
+        parser.error('--compress cannot be used with --archive')
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+
     dataset_url = args.url
     dest_dir = args.dest_dir
-
-    if not os.path.exists(dest_dir):
+    metrics = create_metrics_from_args(args)
+
+    if args.archive:
+        archive_dir = os.path.dirname(os.path.abspath(dest_dir))
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir)
+        elif os.path.isdir(dest_dir):
+            print('Path', dest_dir, 'is a directory', file=sys.stderr)
+            return 1
+    elif not os.path.exists(dest_dir):
         os.makedirs(dest_dir)
     elif not os.path.isdir(dest_dir):
         print('Path', dest_dir, 'exist and is not a directory', file=sys.stderr)
         return 1
 
     print("Dataset URL:", dataset_url)
-    print("Destination directory:", dest_dir)
+    if args.archive:
+        print("Destination archive:", dest_dir)
+        # Graphs of a previous download are kept in the archive, its manifest is the index
+        manifest = GraphArchive(dest_dir, shards=args.shards)
+    else:
+        print("Destination directory:", dest_dir)
+        # Remove files of downloads interrupted by a crash
+        for name in os.listdir(dest_dir):
+            if name.startswith(PARTIAL_PREFIX):
+                os.remove(os.path.join(dest_dir, name))
+        manifest = GraphManifest(os.path.join(dest_dir, DIRECTORY_MANIFEST), scope=dataset_url)
+
+    session = create_session_from_args(args, args.max_workers)
+    scheduler = create_scheduler_from_args(args)
+
+    def on_progress(count, total, task):
+        progress(count, total, suffix='Download data in graph %s        ' % task.graph)
+
+    def on_error(task, exc, trial, retry):
+        print()
+        print('download task for graph %s failed [%i / %i], exception: %s'
+              % (task.graph, trial, scheduler.num_trials, exc), file=sys.stderr)
 
     print('Getting graph list from {} ...'.format(dataset_url))
-    src = SPARQLWrapper(dataset_url + '/sparql')
-    src.setQuery("""SELECT DISTINCT ?g
-    WHERE {
-      GRAPH ?g { ?s ?p ?o }
-    }""")
-    src.setReturnFormat(JSON)
-
-    qr = src.query().convert()
-    graphs = []
-    has_default = False
-    for result in qr["results"]["bindings"]:
-        g = result["g"]["value"]
-        graphs.append(g)
-        has_default = has_default or g == 'default'
-
-    if not has_default:
-        graphs.append('default')
-
-    # get graphs
-    l = len(graphs)
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-
-        progress(0, l, suffix='Prepare tasks')
-        future_to_task = {}
-        for i, g in enumerate(graphs):
-            task = DownloadTask(dataset_url, dest_dir, g, verify=False)
-            future = executor.submit(task.run)
-            future_to_task[future] = task
-            progress(i + 1, l, suffix='Prepare tasks')
-
-        num_trials = 3
-        trial = 0
-
-        while future_to_task:
-            trial += 1
-            repeat_tasks = []
-            l = len(future_to_task)
-            j = 0
-            for future in concurrent.futures.as_completed(future_to_task):
-                task = future_to_task[future]
-                progress(j, l, suffix='Download data [%i / %i] in graph %s        ' % (trial, num_trials, task.graph))
-                try:
-                    future.result()
-                except Exception as exc:
-                    print()
-                    print('download task for graph %s failed, exception: %s' % (task.graph, exc), file=sys.stderr)
-                    repeat_tasks.append(task)
-                else:
-                    # print('task success: %s' % (data,), file=sys.stderr) # DEBUG
-                    pass
-                j += 1
-
-            print()
-
-            future_to_task.clear()
-            if repeat_tasks and trial < num_trials:
-                future_to_task = {executor.submit(task.run): task for task in repeat_tasks}
-
-        print()
-        if repeat_tasks:
-            print('Could not download data for following graphs:', file=sys.stderr)
-            for task in repeat_tasks:
-                print(task.graph, file=sys.stderr)
-            return 1
-        else:
-            print('Successfuly downloaded all data')
-            return 0
+    lister = create_lister_from_args(args, dataset_url)
+    # Largest graphs first requires sizes of all graphs, otherwise downloads start while graphs are listed
+    largest_first = args.order == 'largest'
+    graphs = lister.iter_graphs(sizes=largest_first or args.split_size is not None)
+    split_args = dict(split_size=args.split_size, page_size=args.split_page_size, parallelism=args.split_parallelism)
+    if args.archive:
+        tasks = (ArchiveDownloadTask(dataset_url, manifest, g, session, verify=False, refresh=args.refresh, size=size,
+                                     **split_args)
+                 for g, size in graphs)
+    else:
+        tasks = (DownloadTask(dataset_url, dest_dir, g, session, verify=False, manifest=manifest,
+                              refresh=args.refresh, compression=args.compress, size=size, **split_args)
+                 for g, size in graphs)
+    if largest_first:
+        tasks = list(tasks)
+
+    done_tasks, failed_tasks = scheduler.run(tasks, on_progress=on_progress, on_error=on_error)
+    print()
+    manifest.close()
+
+    if metrics is not None:
+        metrics.close()
+        for line in metrics.summary():
+            print(line)
+
+    print()
+    num_skipped = sum(1 for task in done_tasks if task.skipped)
+    print('Downloaded graphs:', len(done_tasks) - num_skipped)
+    print('Unchanged graphs:', num_skipped)
+    if failed_tasks:
+        print('Could not download data for following graphs:', file=sys.stderr)
+        for task in failed_tasks:
+            print(task.graph, file=sys.stderr)
+        return 1
+    else:
+        print('Successfuly downloaded all data')
+        return 0
 
 
 if __name__ == '__main__':
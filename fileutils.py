@@ -0,0 +1,178 @@
+import bz2
+import gzip
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Compression name -> (file name suffix, magic bytes at the start of compressed files)
+COMPRESSIONS = {
+    'gzip': ('.gz', b'\x1f\x8b'),
+    'bz2': ('.bz2', b'BZh'),
+    'xz': ('.xz', b'\xfd7zXZ\x00'),
+}
+
+# Number of bytes needed to recognize all compressions
+MAGIC_SIZE = 6
+
+# Size of chunks in which graph files are read
+CHUNK_SIZE = 64 * 1024
+
+
+def _open_compressed(file, compression, mode):
+    """
+    Opens file name or file object file, file objects are not closed by closing the returned file.
+    """
+    if compression == 'gzip':
+        return gzip.open(file, mode)
+    if compression == 'bz2':
+        return bz2.open(file, mode)
+    if lzma is None:
+        raise Exception("xz compression requires lzma module")
+    return lzma.open(file, mode)
+
+
+def compression_suffix(compression):
+    """
+    :return: suffix of file names with compression, empty for compression None
+    """
+    if compression is None:
+        return ''
+    return COMPRESSIONS[compression][0]
+
+
+def detect_compression(file_name):
+    """
+    Recognizes compressed files by their content, names of graph files may end with any suffix.
+    :return: compression of the file or None
+    """
+    with open(file_name, 'rb') as fd:
+        magic = fd.read(MAGIC_SIZE)
+    for compression, (suffix, prefix) in COMPRESSIONS.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def strip_compression_suffix(file_name, compression=None):
+    """
+    Removes the suffix of compression from file_name, with compression None any known suffix is removed.
+    """
+    for name, (suffix, magic) in COMPRESSIONS.items():
+        if (compression is None or compression == name) and file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
+def open_graph_file(file_name):
+    """
+    Opens file for binary reading, compressed files are decompressed transparently.
+    """
+    compression = detect_compression(file_name)
+    if compression is None:
+        return open(file_name, 'rb')
+    return _open_compressed(file_name, compression, 'rb')
+
+
+def iter_graph_file(file_name, chunk_size=CHUNK_SIZE):
+    """
+    Yields the content of file in chunks, compressed files are decompressed transparently.
+    """
+    with open_graph_file(file_name) as fd:
+        while True:
+            chunk = fd.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_file_range(file_name, start, end, chunk_size=CHUNK_SIZE):
+    """
+    Yields bytes start to end of uncompressed file in chunks.
+    """
+    with open(file_name, 'rb') as fd:
+        fd.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = fd.read(min(chunk_size, remaining))
+            if not chunk:
+                raise Exception("file %s is truncated" % file_name)
+            remaining -= len(chunk)
+            yield chunk
+
+
+def split_statements(chunks, max_size):
+    """
+    Splits content of a line based serialization (N-Triples, N-Quads or Turtle with one statement per
+    line and without prefixes) into ranges of whole lines of about max_size bytes each.
+    :param chunks: iterable over the content
+    :return: tuple (list of ranges (start, end, number of statements), True if blank nodes occur),
+             or None when the content is not line based
+    """
+    ranges = []
+    blank_nodes = False
+    start = offset = 0
+    statements = 0
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            offset += len(line) + 1
+            line = line.strip()
+            if not line or line.startswith(b'#'):
+                continue
+            if not (line.startswith(b'<') or line.startswith(b'_:')) or not line.endswith(b'.'):
+                return None
+            # Also matches blank node labels in literals, which only makes the caller careful
+            blank_nodes = blank_nodes or b'_:' in line
+            statements += 1
+            if offset - start >= max_size:
+                ranges.append((start, offset, statements))
+                start = offset
+                statements = 0
+    if rest.strip():
+        if not rest.strip().endswith(b'.'):
+            return None
+        offset += len(rest)
+        statements += 1
+    if offset > start:
+        ranges.append((start, offset, statements))
+    return ranges, blank_nodes
+
+
+class ChunkReader(object):
+    """
+    Binary file object reading content from an iterable over its chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                self.pos = 0
+                if self.chunk is None:
+                    self.chunk = b''
+                    break
+                continue
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.pos + size)
+            parts.append(self.chunk[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b''.join(parts)
+
+
+def compressing_writer(fd, compression):
+    """
+    :return: binary file object compressing data written to it into file object fd,
+             closing it does not close fd
+    """
+    return _open_compressed(fd, compression, 'wb')
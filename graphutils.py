@@ -0,0 +1,388 @@
+import asyncio
+import collections
+import itertools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import rdflib
+from urllib.parse import urlencode
+
+from batchutils import graph_term, ntriples_row
+from httputils import create_session
+from metricsutils import in_context, instrument, timed
+from rdfutils import get_reachable_statements
+from taskutils import backoff_delay, is_retryable, retry_after, DEFAULT_BACKOFF, DEFAULT_NUM_TRIALS
+
+# Number of graphs listed by a single query
+DEFAULT_PAGE_SIZE = 10000
+
+# Lists named graphs without matching their triples, stores which do not support it list no graphs
+GRAPHS_PATTERN = 'GRAPH ?g { }'
+QUADS_PATTERN = 'GRAPH ?g { ?s ?p ?o }'
+
+RESULT_HEADERS = {'accept': 'text/tab-separated-values, application/sparql-results+json;q=0.9'}
+
+# Number of triples fetched by a single query of a graph fetched in pages
+DEFAULT_SPLIT_PAGE_SIZE = 100000
+DEFAULT_SPLIT_PARALLELISM = 4
+
+PAGE_HEADERS = {
+    'accept': 'application/n-triples, text/turtle;q=0.5',
+    'content-type': 'application/x-www-form-urlencoded'
+}
+PLAN_HEADERS = {
+    'accept': 'application/sparql-results+json',
+    'content-type': 'application/x-www-form-urlencoded'
+}
+
+# Content type of pages passed on by GraphPages
+PAGE_CONTENT_TYPE = 'application/n-triples'
+
+# Maximal length of chains of blank nodes fetched with the subjects of a page
+BLANK_NODE_DEPTH = 8
+
+
+def graph_pattern(graph, pattern):
+    """
+    :return: pattern matched in graph, the default graph is matched without GRAPH
+    """
+    if graph == 'default':
+        return pattern
+    return 'GRAPH %s { %s }' % (graph_term(graph), pattern)
+
+
+def tsv_value(term):
+    """
+    :return: IRI or lexical form of a term in SPARQL TSV results
+    """
+    if term.startswith('<') and term.endswith('>'):
+        return term[1:-1]
+    if term.startswith('"'):
+        return term[1:term.rindex('"')]
+    return term
+
+
+def parse_tsv(lines):
+    """
+    Parses SPARQL TSV results line by line.
+    :return: iterator over rows, dictionaries mapping variable names to IRIs or lexical forms of bound values
+    """
+    names = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r')
+        if names is None:
+            names = [name.lstrip('?$') for name in line.split('\t')]
+            continue
+        if not line:
+            continue
+        yield dict((name, tsv_value(value)) for name, value in zip(names, line.split('\t')) if value)
+
+
+class GraphLister(object):
+    """
+    Enumerates the named graphs of a dataset with a sequence of queries returning at most
+    page_size graphs each, instead of a single query over all quads. Graphs are listed with
+    the pattern GRAPH ?g { }, which stores answer from their graph index, and fall back to
+    matching quads when it lists no graphs. Pages are ordered by graph name and continue
+    after the last graph of the previous page, so that no query skips over listed graphs.
+    Results are requested as TSV and parsed while they are received. Failed queries are
+    retried like tasks of a TaskScheduler.
+    """
+
+    def __init__(self, dataset_url, session, verify=False, page_size=DEFAULT_PAGE_SIZE,
+                 num_trials=DEFAULT_NUM_TRIALS, backoff=DEFAULT_BACKOFF):
+        self.dataset_url = dataset_url
+        self.query_url = dataset_url + '/sparql'
+        self.session = session
+        self.verify = verify
+        self.page_size = page_size
+        self.num_trials = num_trials
+        self.backoff = backoff
+        self.pattern = GRAPHS_PATTERN
+
+    def select(self, query):
+        """
+        :return: list of result rows of SELECT query, see parse_tsv
+        """
+        trial = 0
+        while True:
+            trial += 1
+            try:
+                return self._select(query)
+            except Exception as exc:
+                if trial >= self.num_trials or not is_retryable(exc):
+                    raise
+                time.sleep(max(backoff_delay(trial, self.backoff), retry_after(exc) or 0))
+
+    def _select(self, query):
+        response = self.session.request("POST", self.query_url, data={'query': query}, headers=RESULT_HEADERS,
+                                        verify=self.verify, stream=True)
+        try:
+            response.raise_for_status()
+            content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+            if content_type == 'text/tab-separated-values':
+                return list(parse_tsv(response.iter_lines()))
+            results = json.loads(response.content)
+            return [dict((name, value['value']) for name, value in binding.items())
+                    for binding in results['results']['bindings']]
+        finally:
+            response.close()
+
+    def count(self, graphs):
+        """
+        :return: dictionary mapping graphs to their number of triples, empty graphs are missing
+        """
+        query = """SELECT ?g (COUNT(*) AS ?n)
+        WHERE {
+          VALUES ?g { %s }
+          GRAPH ?g { ?s ?p ?o }
+        }
+        GROUP BY ?g""" % ' '.join(graph_term(g) for g in graphs)
+        return dict((row['g'], int(row['n'])) for row in self.select(query) if 'g' in row and 'n' in row)
+
+    def iter_graphs(self, sizes=False, default=True):
+        """
+        Yields tuples (graph, number of triples) ordered by graph name while pages are queried, the
+        number of triples is None unless sizes is True. With default the default graph is yielded
+        last as 'default' unless the store lists it itself.
+        """
+        last = None
+        has_default = False
+        while True:
+            condition = '' if last is None else ' FILTER(STR(?g) > %s)' % rdflib.Literal(last).n3()
+            rows = self.select('SELECT DISTINCT ?g WHERE { %s%s } ORDER BY STR(?g) LIMIT %i'
+                               % (self.pattern, condition, self.page_size))
+            # Some stores return a single row without bindings for an empty dataset
+            graphs = [row['g'] for row in rows if 'g' in row]
+            if not graphs and last is None and self.pattern == GRAPHS_PATTERN:
+                self.pattern = QUADS_PATTERN
+                continue
+            counts = self.count(graphs) if sizes and graphs else {}
+            for g in graphs:
+                has_default = has_default or g == 'default'
+                yield g, counts.get(g, 0) if sizes else None
+            if len(rows) < self.page_size or not graphs:
+                break
+            last = graphs[-1]
+        if default and not has_default:
+            yield 'default', None
+
+    def graph_sizes(self):
+        """
+        :return: dictionary mapping names of all named graphs to their number of triples
+        """
+        return dict(self.iter_graphs(sizes=True, default=False))
+
+
+class GraphPages(object):
+    """
+    Fetches a large graph with several CONSTRUCT queries, up to parallelism at a time, instead
+    of a single Graph Store GET. The IRI subjects of the graph are ordered and split into
+    pages of about page_size triples, selected with LIMIT and OFFSET. A page holds all
+    statements of its subjects together with the blank nodes reachable from them through
+    chains of up to BLANK_NODE_DEPTH blank nodes, statements are grouped by subject with
+    rdfutils.get_reachable_statements. Blank node labels are only valid within a query, so
+    blank nodes shared by subjects of different pages are duplicated, and blank nodes not
+    reachable from an IRI subject are missed. Such graphs are detected by comparing the number
+    of fetched statements with the number of triples, see is_complete(). A failed page query
+    is retried alone, pages are passed on as N-Triples in order.
+    """
+
+    def __init__(self, dataset_url, graph, session, verify=False, page_size=DEFAULT_SPLIT_PAGE_SIZE,
+                 parallelism=DEFAULT_SPLIT_PARALLELISM, num_trials=DEFAULT_NUM_TRIALS, backoff=DEFAULT_BACKOFF):
+        self.query_url = dataset_url + '/sparql'
+        self.graph = graph
+        self.session = session
+        self.verify = verify
+        self.page_size = page_size
+        self.parallelism = parallelism
+        self.num_trials = num_trials
+        self.backoff = backoff
+        self.triples = None
+        self.num_pages = None
+        self.page_subjects = None  # number of subjects of a page
+        self.statements = 0  # number of statements passed on
+
+    def plan_query(self):
+        # ?r is unbound for blank node subjects, as the error of 1/0 leaves it unbound
+        return ('SELECT (COUNT(*) AS ?n) (COUNT(DISTINCT ?r) AS ?subjects) WHERE { %s BIND(IF(isIRI(?s), ?s, 1/0) '
+                'AS ?r) }' % graph_pattern(self.graph, '?s ?p ?o'))
+
+    def set_plan(self, content):
+        """
+        Computes the pages from the number of triples and subjects in the results of plan_query().
+        :return: True if the graph is fetched in at least two pages
+        """
+        binding = json.loads(content)['results']['bindings'][0]
+        self.triples = int(binding['n']['value'])
+        subjects = int(binding['subjects']['value'])
+        self.num_pages = min(subjects, -(-self.triples // self.page_size))
+        if self.num_pages < 2:
+            return False
+        self.page_subjects = -(-subjects // self.num_pages)
+        self.num_pages = -(-subjects // self.page_subjects)
+        return True
+
+    def page_query(self, index):
+        subjects = 'SELECT DISTINCT ?r WHERE { %s FILTER(isIRI(?r)) } ORDER BY ?r LIMIT %i OFFSET %i' % (
+            graph_pattern(self.graph, '?r ?rp ?ro'), self.page_subjects, index * self.page_subjects)
+        # Property paths cannot be restricted to blank nodes, chains are matched up to a fixed length
+        statements = ['{ ?r ?p ?o BIND(?r AS ?s) }']
+        nodes = ['?r'] + ['?b%i' % i for i in range(1, BLANK_NODE_DEPTH + 1)]
+        for depth in range(1, BLANK_NODE_DEPTH + 1):
+            chain = ' '.join('%s ?p%i %s FILTER(isBlank(%s))' % (nodes[i - 1], i, nodes[i], nodes[i])
+                             for i in range(1, depth + 1))
+            statements.append('{ %s %s ?p ?o BIND(%s AS ?s) }' % (chain, nodes[depth], nodes[depth]))
+        return 'CONSTRUCT { ?s ?p ?o } WHERE { { %s } %s }' % (
+            subjects, graph_pattern(self.graph, ' UNION '.join(statements)))
+
+    @staticmethod
+    def parse_page(content, content_type):
+        """
+        :return: tuple (statements of the page subjects and their blank node closures as N-Triples, number
+                 of statements)
+        """
+        with timed('parse'):
+            page = rdflib.Graph()
+            page.parse(data=content, format=content_type or 'nt')
+            lines = []
+            seen = {}
+            # Each subject is followed by its blank nodes
+            for subject in sorted(set(s for s in page.subjects() if isinstance(s, rdflib.URIRef))):
+                lines.extend(ntriples_row(stmt) for stmt in get_reachable_statements(subject, page, seen))
+        return ''.join(lines).encode('utf-8'), len(lines)
+
+    def query(self, query, headers):
+        """
+        :return: response of query, failed queries are retried
+        """
+        trial = 0
+        while True:
+            trial += 1
+            try:
+                response = self.session.request("POST", self.query_url, headers=headers, verify=self.verify,
+                                                data=urlencode({'query': query}))
+                response.raise_for_status()
+                return response
+            except Exception as exc:
+                if trial >= self.num_trials or not is_retryable(exc):
+                    raise
+                time.sleep(max(backoff_delay(trial, self.backoff), retry_after(exc) or 0))
+
+    async def query_async(self, query, headers):
+        trial = 0
+        while True:
+            trial += 1
+            try:
+                response = await self.session.request("POST", self.query_url, headers=headers, verify=self.verify,
+                                                      data=urlencode({'query': query}).encode('utf-8'))
+                response.raise_for_status()
+                return response
+            except Exception as exc:
+                if trial >= self.num_trials or not is_retryable(exc):
+                    raise
+                await asyncio.sleep(max(backoff_delay(trial, self.backoff), retry_after(exc) or 0))
+
+    def plan(self):
+        """
+        :return: True if the graph is fetched in at least two pages
+        """
+        return self.set_plan(self.query(self.plan_query(), PLAN_HEADERS).content)
+
+    async def plan_async(self):
+        return self.set_plan((await self.query_async(self.plan_query(), PLAN_HEADERS)).content)
+
+    def fetch_page(self, index):
+        response = self.query(self.page_query(index), PAGE_HEADERS)
+        return self.parse_page(response.content, response.headers.get('content-type', '').split(';')[0].strip())
+
+    async def fetch_page_async(self, index):
+        response = await self.query_async(self.page_query(index), PAGE_HEADERS)
+        content_type = response.headers.get('content-type', '').split(';')[0].strip()
+        # Pages are parsed in a thread, so that the event loop is not blocked
+        return await asyncio.get_event_loop().run_in_executor(None, in_context(self.parse_page), response.content,
+                                                              content_type)
+
+    def iter_ntriples(self):
+        """
+        Yields the pages as N-Triples in order, while the next pages are fetched.
+        """
+        self.statements = 0
+        indexes = iter(range(self.num_pages))
+        with ThreadPoolExecutor(self.parallelism) as executor:
+            # Pages are fetched in the context of the task, so that their requests are recorded for its graph
+            futures = collections.deque(executor.submit(in_context(self.fetch_page), index)
+                                        for index in itertools.islice(indexes, self.parallelism))
+            try:
+                while futures:
+                    data, statements = futures.popleft().result()
+                    futures.extend(executor.submit(in_context(self.fetch_page), index)
+                                   for index in itertools.islice(indexes, 1))
+                    self.statements += statements
+                    # Empty chunks end chunked request bodies
+                    if data:
+                        yield data
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    async def aiter_ntriples(self):
+        """
+        Coroutine version of iter_ntriples() for the async engine.
+        """
+        self.statements = 0
+        indexes = iter(range(self.num_pages))
+        futures = collections.deque(asyncio.ensure_future(self.fetch_page_async(index))
+                                    for index in itertools.islice(indexes, self.parallelism))
+        try:
+            while futures:
+                data, statements = await futures.popleft()
+                futures.extend(asyncio.ensure_future(self.fetch_page_async(index))
+                               for index in itertools.islice(indexes, 1))
+                self.statements += statements
+                if data:
+                    yield data
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def is_complete(self):
+        """
+        :return: True if the pages passed on hold exactly the triples of the graph
+        """
+        return self.statements == self.triples
+
+
+def add_listing_arguments(parser):
+    """
+    Adds options of GraphLister to argparse parser.
+    """
+    parser.add_argument('--page-size', metavar='N', type=int, default=DEFAULT_PAGE_SIZE,
+                        help='number of graphs listed by a single query')
+
+
+def add_split_arguments(parser):
+    """
+    Adds options of fetching large graphs in pages with GraphPages to argparse parser.
+    """
+    parser.add_argument('--split-size', metavar='N', type=int,
+                        help='fetch graphs with at least N triples with parallel CONSTRUCT queries of pages of their '
+                             'subjects instead of a single request, graphs whose blank nodes cannot be split '
+                             'between pages are fetched again with a single request')
+    parser.add_argument('--split-page-size', metavar='N', type=int, default=DEFAULT_SPLIT_PAGE_SIZE,
+                        help='number of triples of a page of graphs fetched in pages')
+    parser.add_argument('--split-parallelism', metavar='N', type=int, default=DEFAULT_SPLIT_PARALLELISM,
+                        help='number of pages of a graph fetched at a time')
+
+
+def create_lister_from_args(args, dataset_url):
+    """
+    Creates a GraphLister with its own session, graphs are listed with blocking requests also
+    with the async engine, as tasks of an iterator are taken in a background thread.
+    """
+    session = instrument(create_session(1, connect_timeout=args.connect_timeout, read_timeout=args.read_timeout))
+    return GraphLister(dataset_url, session, page_size=args.page_size, num_trials=args.trials,
+                       backoff=args.backoff)
@@ -0,0 +1,132 @@
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+import rdflib
+
+from metricsutils import record
+from rdfutils import calc_hash_digest
+from taskutils import positive_int
+
+CPU_COUNT = 1
+try:
+    import multiprocessing
+
+    CPU_COUNT = multiprocessing.cpu_count()
+except (ImportError, NotImplementedError):
+    pass
+
+
+def write_temp_file(chunks, tmp_dir=None):
+    """
+    Writes chunks of a downloaded graph to a new temporary file, so that the data is never held in memory.
+    The file is removed when writing fails.
+    :return: name of the temporary file
+    """
+    fd = tempfile.NamedTemporaryFile(prefix='graph-', suffix='.ttl', dir=tmp_dir, delete=False)
+    try:
+        with fd:
+            for chunk in chunks:
+                fd.write(chunk)
+    except BaseException:
+        os.remove(fd.name)
+        raise
+    return fd.name
+
+
+async def write_temp_file_async(chunks, tmp_dir=None):
+    """
+    Version of write_temp_file() for an asynchronous iterator over chunks.
+    """
+    fd = tempfile.NamedTemporaryFile(prefix='graph-', suffix='.ttl', dir=tmp_dir, delete=False)
+    try:
+        with fd:
+            async for chunk in chunks:
+                fd.write(chunk)
+    except BaseException:
+        os.remove(fd.name)
+        raise
+    return fd.name
+
+
+def hash_graph_file(file_name, format, hash="sha256", remove=False):
+    """
+    Computes hash of the graph stored in file file_name, removes the file afterwards when remove is True.
+    :return: tuple (hash, number of triples, seconds of parsing, seconds of hashing), the process pool
+             cannot record metrics itself
+    """
+    try:
+        start = time.time()
+        graph = rdflib.Graph()
+        graph.parse(file_name, format=format)
+        parsed = time.time()
+        return calc_hash_digest(graph, hash=hash), len(graph), parsed - start, time.time() - parsed
+    finally:
+        if remove:
+            os.remove(file_name)
+
+
+class HashStage(object):
+    """
+    Parses and hashes downloaded graph files in a process pool. At most queue_size graphs
+    (by default twice the number of workers) wait for a free worker process, submit() blocks
+    while the queue is full.
+    """
+
+    def __init__(self, executor, workers, queue_size=None):
+        self.executor = executor
+        if queue_size is None:
+            queue_size = 2 * workers
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, file_name, format, graph=None, remove=True):
+        """
+        Submits the graph in file file_name for hashing, with remove the file is removed after hashing.
+        Durations of parsing and hashing are recorded for graph.
+        :return: future of tuple (hash, number of triples) of the graph
+        """
+        try:
+            self.slots.acquire()
+        except BaseException:
+            if remove:
+                os.remove(file_name)
+            raise
+        try:
+            future = self.executor.submit(hash_graph_file, file_name, format, remove=remove)
+        except BaseException:
+            self.slots.release()
+            if remove:
+                os.remove(file_name)
+            raise
+        result = Future()
+
+        def done(future):
+            self.slots.release()
+            try:
+                digest, size, parse_seconds, hash_seconds = future.result()
+            except BaseException as e:
+                # The worker does not remove the file when the job could not be sent to it
+                if remove and os.path.exists(file_name):
+                    os.remove(file_name)
+                result.set_exception(e)
+                return
+            record('parse', graph, seconds=parse_seconds)
+            record('hash', graph, seconds=hash_seconds)
+            result.set_result((digest, size))
+
+        future.add_done_callback(done)
+        return result
+
+
+def add_hash_arguments(parser):
+    """
+    Adds options of HashStage to argparse parser.
+    """
+    parser.add_argument('--hash-workers', metavar='N', type=positive_int, default=CPU_COUNT,
+                        help='number of processes parsing and hashing graphs')
+    parser.add_argument('--hash-queue', metavar='N', type=int, default=None,
+                        help='number of downloaded graphs waiting for hashing (default: 2 * hash workers)')
+    parser.add_argument('--tmp-dir', metavar='DIR',
+                        help='directory for downloaded graphs waiting for hashing')
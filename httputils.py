@@ -0,0 +1,263 @@
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+
+from metricsutils import instrument
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_READ_TIMEOUT = 600
+
+# Number of hosts for which connection pools are kept, the dataset tools talk to one or two servers
+POOL_CONNECTIONS = 10
+
+# Size of chunks in which streamed bodies are forwarded
+CHUNK_SIZE = 64 * 1024
+
+LENGTH_REQUIRED = 411
+
+
+def create_session(pool_size, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                   http2=False):
+    """
+    Creates a session shared by all tasks of a tool. Connections are kept alive and
+    reused, each host gets a pool of pool_size connections, so that every worker
+    thread can hold a connection. Responses are transferred gzip or deflate encoded.
+    Requests without explicit timeout use connect_timeout and read_timeout (seconds, None for no timeout).
+    With http2 requests are multiplexed over HTTP/2 connections (requires httpx with h2).
+    """
+    timeout = (connect_timeout, read_timeout)
+    if http2:
+        if httpx is None:
+            raise Exception("HTTP/2 requires httpx package with h2 (pip install httpx[http2])")
+        adapter = HTTP2Adapter(pool_size, timeout)
+    else:
+        adapter = TimeoutHTTPAdapter(timeout, pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['accept-encoding'] = 'gzip, deflate'
+    return session
+
+
+def add_transport_arguments(parser):
+    """
+    Adds options of create_session to argparse parser.
+    """
+    parser.add_argument('--connect-timeout', metavar='SECONDS', type=float, default=DEFAULT_CONNECT_TIMEOUT,
+                        help='timeout of establishing connections')
+    parser.add_argument('--read-timeout', metavar='SECONDS', type=float, default=DEFAULT_READ_TIMEOUT,
+                        help='timeout of waiting for data from the server')
+    parser.add_argument('--http2', action='store_true',
+                        help='multiplex requests over HTTP/2 connections (requires httpx with h2)')
+
+
+def create_session_from_args(args, pool_size):
+    """
+    Creates the session of the engine selected by args.engine (see taskutils.add_scheduler_arguments).
+    """
+    if getattr(args, 'engine', 'thread') == 'async':
+        from asyncutils import AsyncSession
+
+        return instrument(AsyncSession(pool_size, connect_timeout=args.connect_timeout,
+                                       read_timeout=args.read_timeout, http2=args.http2))
+    return instrument(create_session(pool_size, connect_timeout=args.connect_timeout,
+                                     read_timeout=args.read_timeout, http2=args.http2))
+
+
+def content_length(response):
+    """
+    :return: length of the decoded body of the response or None if it is not known in advance
+    """
+    if response.headers.get('content-encoding', 'identity').lower() != 'identity':
+        return None
+    value = response.headers.get('content-length')
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def is_length_required(exc):
+    """
+    :return: True if exc reports that the server does not accept bodies without Content-Length
+    """
+    return (isinstance(exc, requests.HTTPError) and exc.response is not None and
+            exc.response.status_code == LENGTH_REQUIRED)
+
+
+class StreamBody(object):
+    """
+    Request body forwarding the content of a response received with stream=True chunk by chunk,
+    so that at most a few chunks are held in memory. The body is sent with Content-Length when
+    the length of the response is known, otherwise with chunked transfer encoding.
+    """
+
+    def __init__(self, response, chunk_size=CHUNK_SIZE):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.length = content_length(response)
+
+    def __iter__(self):
+        return self.response.iter_content(self.chunk_size)
+
+    def __len__(self):
+        # requests uses chunked transfer encoding for length 0
+        return self.length or 0
+
+    def __bool__(self):
+        # requests replaces false request bodies by an empty body
+        return True
+
+    __nonzero__ = __bool__
+
+
+class FileBody(StreamBody):
+    """
+    Request body streamed from a file, chunks is a function returning a new iterator over the
+    content each time the body is sent, so that retries read the file again from its start.
+    The body is sent with Content-Length length, or with chunked transfer encoding when the
+    length is None.
+    """
+
+    def __init__(self, chunks, length=None):
+        self.chunks = chunks
+        self.length = length
+
+    def __iter__(self):
+        return self.chunks()
+
+    async def aiter(self):
+        """
+        Iterates over the content for the async engine.
+        """
+        for chunk in self.chunks():
+            yield chunk
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTP adapter with a default timeout.
+    """
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, timeout=timeout, **kwargs)
+
+
+class HTTP2Adapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter sending requests of a requests session with httpx over HTTP/2.
+    """
+
+    def __init__(self, pool_size, timeout):
+        super(HTTP2Adapter, self).__init__()
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.clients = {}  # verify -> httpx client
+
+    def _client(self, verify):
+        client = self.clients.get(verify)
+        if client is None:
+            client = self.clients[verify] = httpx.Client(http2=True, limits=self.limits, verify=verify)
+        return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if timeout is None:
+            timeout = self.timeout
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+            timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=read_timeout, pool=None)
+        else:
+            timeout = httpx.Timeout(timeout)
+        client = self._client(verify)
+        body = request.body
+        if hasattr(body, 'read'):
+            body = _iter_file(body)
+        elif isinstance(body, StreamBody):
+            body = iter(body)
+        try:
+            http_request = client.build_request(request.method, request.url, headers=dict(request.headers),
+                                                content=body, timeout=timeout)
+            http_response = client.send(http_request, stream=True)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+        response = requests.Response()
+        response.status_code = http_response.status_code
+        response.reason = http_response.reason_phrase
+        # Content is decoded by httpx, so the length of the encoded content does not apply
+        response.headers = CaseInsensitiveDict(http_response.headers)
+        if response.headers.pop('content-encoding', None) is not None:
+            response.headers.pop('content-length', None)
+        response.raw = _HTTPXRawResponse(http_response)
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.connection = self
+        if not stream:
+            response.content  # Read the whole response like requests does
+        return response
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+
+
+class _HTTPXRawResponse(object):
+    """
+    File-like object reading decoded content of a httpx response, used as raw of requests responses.
+    """
+
+    def __init__(self, http_response):
+        self.http_response = http_response
+        self.chunks = http_response.iter_bytes()
+        self.buffer = b''
+
+    def read(self, amt=None):
+        while amt is None or len(self.buffer) < amt:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if amt is None:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        if not data:
+            self.close()
+        return data
+
+    def tell(self):
+        """
+        :return: number of bytes received, before decoding
+        """
+        return self.http_response.num_bytes_downloaded
+
+    def close(self):
+        self.http_response.close()
+
+    def release_conn(self):
+        self.close()
+
+
+def _iter_file(fd, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
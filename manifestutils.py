@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')),
+                                 'rdf-utils')
+
+# Columns of a manifest entry besides scope and graph
+ENTRY_FIELDS = ('file', 'size', 'hash', 'etag', 'last_modified')
+
+# Name of the manifest in directories written by download-dataset.py and prefix of its partially written files
+DIRECTORY_MANIFEST = '.manifest.sqlite'
+PARTIAL_PREFIX = '.partial-'
+
+
+def is_manifest_file(name):
+    """
+    :return: True if name is the name of a directory manifest (or its journal) or of a partially written file
+    """
+    return name.startswith(DIRECTORY_MANIFEST) or name.startswith(PARTIAL_PREFIX)
+
+
+class GraphManifest(object):
+    """
+    Persistent record of graphs transferred by the dataset tools, stored in a SQLite database.
+    Entries of different transfers sharing one database are separated by scope, e.g. the
+    source and destination URLs. An entry is a dictionary with keys ENTRY_FIELDS, fields
+    unknown to the tool are None. The manifest can be used from several threads.
+    """
+
+    def __init__(self, path, scope=''):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.scope = scope
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            # Committed entries survive crashes of the tool, only a power loss may lose the last ones
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS graphs (
+                scope TEXT NOT NULL,
+                graph TEXT NOT NULL,
+                file TEXT,
+                size INTEGER,
+                hash TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (scope, graph))""")
+
+    def get(self, graph):
+        """
+        :return: entry of graph or None
+        """
+        with self.lock:
+            row = self.db.execute("SELECT " + ', '.join(ENTRY_FIELDS) + " FROM graphs WHERE scope = ? AND graph = ?",
+                                  (self.scope, graph)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(ENTRY_FIELDS, row))
+
+    def put(self, graph, **fields):
+        """
+        Replaces the entry of graph, fields missing in fields are set to None.
+        """
+        values = [fields.get(name) for name in ENTRY_FIELDS]
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO graphs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [self.scope, graph] + values + [time.time()])
+
+    def remove(self, graph):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM graphs WHERE scope = ? AND graph = ?", (self.scope, graph))
+
+    def graphs(self):
+        """
+        :return: names of all graphs with an entry
+        """
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT graph FROM graphs WHERE scope = ?", (self.scope,))]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,449 @@
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+METRICS_FORMATS = ('jsonl', 'prometheus')
+
+# Stages of records in the order of the summary
+STAGES = ('request', 'parse', 'hash', 'task')
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Number of values per series from which quantiles are computed, larger series are sampled
+SAMPLE_SIZE = 100000
+
+# Seconds between rewrites of a Prometheus textfile
+PROMETHEUS_INTERVAL = 10.0
+
+# Seconds between redraws of the progress bar
+PROGRESS_INTERVAL = 0.2
+
+# Metrics receiving records, see Metrics.start()
+_active = None
+
+# Graph of the running task, requests and stages are recorded for it
+_graph = contextvars.ContextVar('graph', default=None)
+
+# Times to first byte of the requests of the running task by endpoint, see collect_latencies()
+_latencies = contextvars.ContextVar('latencies', default=None)
+
+
+def set_graph(graph):
+    """
+    Sets the graph of the task running in the current thread or coroutine.
+    """
+    _graph.set(graph)
+
+
+def current_graph(url=None):
+    """
+    :return: graph of the running task or the graph parameter of url
+    """
+    graph = _graph.get()
+    if graph is None and url is not None:
+        graph = parse_qs(urlsplit(url).query).get('graph', [None])[0]
+    return graph
+
+
+def collect_latencies():
+    """
+    Starts collecting times to the first byte of the requests of the task running in the current
+    thread or coroutine, including requests of functions passed to executors with in_context().
+    :return: dictionary mapping endpoints (scheme and host) to lists of seconds, filled while the task runs
+    """
+    latencies = {}
+    _latencies.set(latencies)
+    return latencies
+
+
+def _add_latency(url, seconds):
+    latencies = _latencies.get()
+    if latencies is not None:
+        parts = urlsplit(url)
+        latencies.setdefault(parts.scheme + '://' + parts.netloc, []).append(seconds)
+
+
+def in_context(func):
+    """
+    :return: function calling func in a copy of the current context, so that work passed to an
+             executor is recorded for the graph of the task, a copy must be made for every call
+    """
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def record(stage, graph=None, **values):
+    """
+    Records values of stage for graph (by default the graph of the running task) when metrics are collected.
+    """
+    if _active is not None:
+        _active.record(stage, current_graph() if graph is None else graph, **values)
+
+
+@contextlib.contextmanager
+def timed(stage, graph=None):
+    """
+    Records the duration of the with block as seconds of stage.
+    """
+    if _active is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(stage, graph, seconds=time.time() - start)
+
+
+def set_progress(count, total):
+    if _active is not None:
+        _active.set_progress(count, total)
+
+
+def _body_length(data, headers=None):
+    """
+    :return: length of a request body or None when it is not known in advance
+    """
+    if headers and 'content-length' in headers:
+        return int(headers['content-length'])
+    if data is None:
+        return 0
+    if isinstance(data, bytes):
+        return len(data)
+    if isinstance(data, str):
+        return len(data.encode('utf-8'))
+    if isinstance(data, dict):
+        return len(urlencode(data))
+    return getattr(data, 'length', None)
+
+
+def instrument(session):
+    """
+    Records every request of session, a requests session or an asyncutils.AsyncSession, when
+    metrics are collected. Streamed responses are recorded when they are closed. Times to first
+    byte are collected for the running task in any case, see collect_latencies().
+    :return: session
+    """
+    if hasattr(session, 'aclose'):
+        session.request = _async_request(session.request)
+    else:
+        session.request = _request(session.request)
+    return session
+
+
+def _request(request):
+    def timed_request(method, url, **kwargs):
+        start = time.time()
+        graph = current_graph(url)
+        sent = _body_length(kwargs.get('data'), kwargs.get('headers'))
+        try:
+            response = request(method, url, **kwargs)
+        except Exception as e:
+            record('request', graph, method=method, seconds=time.time() - start, bytes_sent=sent, error=str(e))
+            raise
+        _add_latency(url, response.elapsed.total_seconds())
+
+        def finish():
+            received = response.raw.tell() if hasattr(response.raw, 'tell') else len(response.content)
+            record('request', graph, method=method, status=response.status_code, seconds=time.time() - start,
+                   ttfb=response.elapsed.total_seconds(), bytes_received=received, bytes_sent=sent)
+
+        if kwargs.get('stream'):
+            response.close = _closing(response.close, finish)
+        else:
+            finish()
+        return response
+
+    return timed_request
+
+
+def _async_request(request):
+    async def timed_request(method, url, headers=None, data=None, verify=True, stream=False):
+        start = time.time()
+        graph = current_graph(url)
+        sent = _body_length(data, headers)
+        try:
+            response = await request(method, url, headers=headers, data=data, verify=verify, stream=True)
+        except Exception as e:
+            record('request', graph, method=method, seconds=time.time() - start, bytes_sent=sent, error=str(e))
+            raise
+        ttfb = time.time() - start
+        _add_latency(url, ttfb)
+
+        def finish():
+            record('request', graph, method=method, status=response.status_code, seconds=time.time() - start,
+                   ttfb=ttfb, bytes_received=response.http_response.num_bytes_downloaded, bytes_sent=sent)
+
+        aclose = response.aclose
+        finished = []
+
+        async def aclose_response():
+            await aclose()
+            if not finished:
+                finished.append(True)
+                finish()
+
+        response.aclose = aclose_response
+        if not stream:
+            try:
+                await response.read()
+            finally:
+                await response.aclose()
+        return response
+
+    return timed_request
+
+
+def _closing(close, finish):
+    """
+    :return: function calling close and finish, finish is called only once
+    """
+    finished = []
+
+    def closing():
+        close()
+        if not finished:
+            finished.append(True)
+            finish()
+
+    return closing
+
+
+class _Series(object):
+    """
+    Count, sum and a uniform sample of at most SAMPLE_SIZE values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.sample = []
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if len(self.sample) < SAMPLE_SIZE:
+            self.sample.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < SAMPLE_SIZE:
+                self.sample[index] = value
+
+    def quantiles(self):
+        """
+        :return: list of values at QUANTILES (nearest rank)
+        """
+        values = sorted(self.sample)
+        if not values:
+            return [0.0 for q in QUANTILES]
+        return [values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES]
+
+
+class _StageStats(object):
+    def __init__(self):
+        self.seconds = _Series()
+        self.ttfb = _Series()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.errors = 0
+        self.retries = 0
+
+
+class Metrics(object):
+    """
+    Collects timings of a tool run: a record for every HTTP request (bytes received and sent,
+    seconds until the body was read, time to first byte), for parsing and hashing a graph and
+    for every run of a task, whose trial number counts retries. Records carry the graph of the
+    task they belong to. With format 'jsonl' records are appended to path as JSON Lines while
+    they are collected. With format 'prometheus' path is a textfile for the node exporter with
+    the statistics of each stage, it is rewritten every PROMETHEUS_INTERVAL seconds, so that
+    long runs can be followed. summary() reports throughput and latency quantiles.
+    """
+
+    def __init__(self, path=None, format='jsonl'):
+        self.path = path
+        self.format = format
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stages = dict((stage, _StageStats()) for stage in STAGES)
+        self.progress = None  # (finished tasks, total tasks)
+        self.written = 0  # time of the last write of the textfile
+        self.fd = None
+        if path is not None and format == 'jsonl':
+            self.fd = open(path, 'a')
+
+    def start(self):
+        """
+        Makes the module functions record(), timed() and instrument() collect into these metrics.
+        :return: self
+        """
+        global _active
+        _active = self
+        return self
+
+    def record(self, stage, graph, **values):
+        values = dict((key, value) for key, value in values.items() if value is not None)
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = _StageStats()
+            if 'seconds' in values:
+                stats.seconds.add(values['seconds'])
+            if 'ttfb' in values:
+                stats.ttfb.add(values['ttfb'])
+            stats.bytes_received += values.get('bytes_received', 0)
+            stats.bytes_sent += values.get('bytes_sent', 0)
+            if 'error' in values or values.get('status', 0) >= 400:
+                stats.errors += 1
+            if values.get('trial', 1) > 1:
+                stats.retries += 1
+            if self.fd is not None:
+                values.update(time=round(time.time(), 3), stage=stage, graph=graph)
+                self.fd.write(json.dumps(values, sort_keys=True) + '\n')
+            elif self.path is not None and time.time() - self.written >= PROMETHEUS_INTERVAL:
+                self.write_textfile()
+
+    def set_progress(self, count, total):
+        with self.lock:
+            self.progress = (count, total)
+
+    def write_textfile(self):
+        lines = []
+        for name, help_text in (('stage_seconds', 'Duration of requests, parsing, hashing and task runs'),
+                                ('ttfb_seconds', 'Time to the first byte of responses')):
+            lines.append('# HELP rdf_utils_%s %s' % (name, help_text))
+            lines.append('# TYPE rdf_utils_%s summary' % name)
+            for stage in sorted(self.stages):
+                series = self.stages[stage].seconds if name == 'stage_seconds' else self.stages[stage].ttfb
+                if not series.count:
+                    continue
+                for q, value in zip(QUANTILES, series.quantiles()):
+                    lines.append('rdf_utils_%s{stage="%s",quantile="%s"} %.6f' % (name, stage, q, value))
+                lines.append('rdf_utils_%s_sum{stage="%s"} %.6f' % (name, stage, series.sum))
+                lines.append('rdf_utils_%s_count{stage="%s"} %i' % (name, stage, series.count))
+        for name, help_text, attribute in (('received_bytes', 'Bytes received', 'bytes_received'),
+                                           ('sent_bytes', 'Bytes sent', 'bytes_sent'),
+                                           ('errors', 'Failed requests and task runs', 'errors'),
+                                           ('retries', 'Task runs after the first trial', 'retries')):
+            lines.append('# HELP rdf_utils_%s_total %s' % (name, help_text))
+            lines.append('# TYPE rdf_utils_%s_total counter' % name)
+            for stage in sorted(self.stages):
+                lines.append('rdf_utils_%s_total{stage="%s"} %i' % (name, stage,
+                                                                    getattr(self.stages[stage], attribute)))
+        if self.progress is not None:
+            for name, value in zip(('finished', 'total'), self.progress):
+                lines.append('# TYPE rdf_utils_tasks_%s gauge' % name)
+                lines.append('rdf_utils_tasks_%s %i' % (name, value))
+        # The node exporter must never read a partial file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
+        self.written = time.time()
+
+    def summary(self):
+        """
+        :return: list of lines reporting throughput and latency quantiles of each stage
+        """
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        lines = ['Metrics of %.1f s:' % elapsed]
+        with self.lock:
+            for stage in sorted(self.stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+                stats = self.stages[stage]
+                if not stats.seconds.count:
+                    continue
+                parts = ['%i times, %.1f s' % (stats.seconds.count, stats.seconds.sum)]
+                if stats.bytes_received or stats.bytes_sent:
+                    parts.append('%s received (%s/s), %s sent (%s/s)' % (
+                        format_bytes(stats.bytes_received), format_bytes(stats.bytes_received / elapsed),
+                        format_bytes(stats.bytes_sent), format_bytes(stats.bytes_sent / elapsed)))
+                parts.append('latency ' + format_quantiles(stats.seconds))
+                if stats.ttfb.count:
+                    parts.append('first byte ' + format_quantiles(stats.ttfb))
+                if stats.errors:
+                    parts.append('%i failed' % stats.errors)
+                if stats.retries:
+                    parts.append('%i retries' % stats.retries)
+                lines.append('  %s: %s' % (stage, ', '.join(parts)))
+        return lines
+
+    def close(self):
+        global _active
+        if _active is self:
+            _active = None
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+            elif self.path is not None:
+                self.write_textfile()
+
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TiB' % size
+
+
+def format_quantiles(series):
+    return ' '.join('p%i %.3f s' % (q * 100, value) for q, value in zip(QUANTILES, series.quantiles()))
+
+
+class ProgressBar(object):
+    """
+    Progress bar redrawn in place at most every PROGRESS_INTERVAL seconds and when all tasks
+    finished. It is not drawn when stdout is not a terminal, progress is passed to the metrics anyway.
+    """
+
+    def __init__(self, stream=None, interval=PROGRESS_INTERVAL):
+        self.stream = sys.stdout if stream is None else stream
+        self.interval = interval
+        self.enabled = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.drawn = 0  # time of the last redraw
+
+    def __call__(self, count, total, suffix=''):
+        set_progress(count, total)
+        if not self.enabled:
+            return
+        now = time.time()
+        if count < total and now - self.drawn < self.interval:
+            return
+        self.drawn = now
+        bar_len = 60
+        filled_len = int(round(bar_len * count / float(total)))
+
+        percents = round(100.0 * count / float(total), 1)
+        bar = '=' * filled_len + '-' * (bar_len - filled_len)
+
+        self.stream.write('[%s] %s%s ...%s\r' % (bar, percents, '%', suffix))
+        self.stream.flush()  # As suggested by Rom Ruben
+
+
+def add_metrics_arguments(parser):
+    """
+    Adds options of Metrics to argparse parser.
+    """
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='record bytes, latency, time to first byte, parse and hash time and retries of every '
+                             'graph in FILE and print a summary at the end')
+    parser.add_argument('--metrics-format', choices=METRICS_FORMATS, default='jsonl',
+                        help='write metrics as JSON Lines, one record per request, stage and task run, or as '
+                             'Prometheus textfile with statistics of each stage, rewritten during the run')
+
+
+def create_metrics_from_args(args):
+    """
+    :return: started Metrics or None when no metrics are collected
+    """
+    if args.metrics is None:
+        return None
+    return Metrics(args.metrics, args.metrics_format).start()
@@ -1,39 +1,287 @@
-#!/usr/bin/env python
-from __future__ import print_function
-
+#!/usr/bin/env python3
+import os
 import sys
+import time
+import sqlite3
 import hashlib
 import argparse
 import logging
+import concurrent.futures
 import rdflib
 import rdflib.util
-from rdfutils import calc_hash_value
+from rdfutils import calc_hash_digest, calc_file_hash_digest
+from manifestutils import DEFAULT_CACHE_DIR, is_manifest_file
+from fileutils import open_graph_file, strip_compression_suffix
 
 INPUT_FORMATS = [i.name for i in rdflib.plugin.plugins(kind=rdflib.parser.Parser)]
 
+# Formats which can be hashed out-of-core
+STREAM_FORMATS = ('nt', 'nt11', 'ntriples', 'application/n-triples', 'nquads', 'application/n-quads')
+
+# Formats with named graphs, the union of all graphs is hashed
+QUAD_FORMATS = ('nquads', 'application/n-quads', 'trig', 'application/trig', 'trix', 'application/trix')
+
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+# Number of bytes read from the start and the end of a file for the cache key
+CACHE_SAMPLE_SIZE = 64 * 1024
+
+# Number of files submitted to the process pool per worker process
+PENDING_PER_JOB = 4
+
+
+def parse_size(value):
+    """
+    Parses size in bytes with optional K, M or G suffix
+    """
+    multiplier = SIZE_SUFFIXES.get(value[-1:].lower())
+    if multiplier is not None:
+        value = value[:-1]
+    else:
+        multiplier = 1
+    try:
+        return int(value) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(value))
+
+
+class HashCache(object):
+    """
+    Persistent cache of graph hashes of files stored in a SQLite database.
+    Entry is valid as long as path, size, modification time and a digest of
+    the first and the last CACHE_SAMPLE_SIZE bytes of the file are unchanged.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_age=None, max_entries=None):
+        """
+        :param max_age: entries not used for max_age seconds are evicted
+        :param max_entries: only max_entries most recently used entries are kept
+        """
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'hashes.sqlite'), timeout=60)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT NOT NULL,
+                format TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sample TEXT NOT NULL,
+                value TEXT NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (path, format, hash))""")
+
+    @staticmethod
+    def file_key(file_name):
+        """
+        :return: tuple (path, size, mtime, sample digest) identifying the file content
+        """
+        path = os.path.abspath(file_name)
+        st = os.stat(path)
+        sample = hashlib.sha1()
+        with open(path, 'rb') as fd:
+            sample.update(fd.read(CACHE_SAMPLE_SIZE))
+            if st.st_size > 2 * CACHE_SAMPLE_SIZE:
+                fd.seek(-CACHE_SAMPLE_SIZE, os.SEEK_END)
+            sample.update(fd.read())
+        return path, st.st_size, st.st_mtime, sample.hexdigest()
 
-def hash_file(file_name, format="auto", hash="sha256"):
-    if file_name == '-' or file_name == '':
-        if format == "auto":
+    def get(self, key, format, hash):
+        """
+        :return: cached hash value or None
+        """
+        path, size, mtime, sample = key
+        with self.db:
+            row = self.db.execute("SELECT size, mtime, sample, value FROM hashes "
+                                  "WHERE path = ? AND format = ? AND hash = ?",
+                                  (path, format, hash)).fetchone()
+            if row is None or tuple(row[:3]) != (size, mtime, sample):
+                return None
+            self.db.execute("UPDATE hashes SET accessed = ? WHERE path = ? AND format = ? AND hash = ?",
+                            (time.time(), path, format, hash))
+        return row[3]
+
+    def put(self, key, format, hash, value):
+        path, size, mtime, sample = key
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (path, format, hash, size, mtime, sample, value, time.time()))
+
+    def evict(self):
+        """
+        Removes entries older than max_age and least recently used entries above max_entries.
+        """
+        with self.db:
+            if self.max_age is not None:
+                self.db.execute("DELETE FROM hashes WHERE accessed < ?", (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                self.db.execute("DELETE FROM hashes WHERE rowid NOT IN "
+                                "(SELECT rowid FROM hashes ORDER BY accessed DESC LIMIT ?)",
+                                (self.max_entries,))
+
+    def close(self):
+        self.evict()
+        self.db.close()
+
+
+def is_stdin(file_name):
+    return file_name == '-' or file_name == ''
+
+
+def guess_input_format(file_name, format="auto"):
+    if format == 'auto':
+        if is_stdin(file_name):
             raise Exception("Cannot guess RDF format from stdin")
-        data = sys.stdin.read()
+        format = rdflib.util.guess_format(strip_compression_suffix(file_name))
+    return format
+
+
+def iter_input_files(files, files_from=None, recursive=False):
+    """
+    Yields file names from files, directories in files are walked when recursive is True.
+    Names listed one per line in file files_from ('-' for stdin) follow.
+    """
+    for fn in files:
+        if recursive and os.path.isdir(fn):
+            for root, dirs, names in os.walk(fn):
+                dirs.sort()
+                for name in sorted(names):
+                    # Manifests of download-dataset.py are not graphs
+                    if not is_manifest_file(name):
+                        yield os.path.join(root, name)
+        else:
+            yield fn
+    if files_from is not None:
+        fd = sys.stdin if is_stdin(files_from) else open(files_from)
+        try:
+            for line in fd:
+                line = line.rstrip('\r\n')
+                if line:
+                    yield line
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+
+
+def hash_files(file_names, format="auto", hash="sha256", jobs=1, ordered=True, memory_limit=None, tmp_dir=None,
+               cache=None, graph_jobs=1):
+    """
+    Computes hashes of RDF graphs in files, with jobs > 1 files are hashed by a pool of jobs processes.
+    Cache is only accessed by the calling process.
+    :param graph_jobs: number of processes used to hash a single graph when jobs <= 1
+    :param ordered: yield results in order of file_names, otherwise in order of completion
+    :return: iterator of tuples (file name, hash value, exception), exception is None on success
+    """
+    if jobs is None or jobs <= 1:
+        for fn in file_names:
+            try:
+                yield fn, hash_file(fn, format=format, hash=hash, jobs=graph_jobs, memory_limit=memory_limit,
+                                    tmp_dir=tmp_dir, cache=cache), None
+            except Exception as exc:
+                yield fn, None, exc
+        return
+
+    results = {}  # index -> result not yet yielded
+    next_index = 0
+    pending = {}  # future -> (index, file name, cache key, format)
+    files = enumerate(file_names)
+    exhausted = False
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        while not exhausted or pending:
+            while not exhausted and len(pending) < jobs * PENDING_PER_JOB:
+                item = next(files, None)
+                if item is None:
+                    exhausted = True
+                    break
+                index, fn = item
+                try:
+                    if is_stdin(fn):
+                        # stdin can only be read by this process
+                        results[index] = (fn, hash_file(fn, format=format, hash=hash, memory_limit=memory_limit,
+                                                        tmp_dir=tmp_dir), None)
+                        continue
+                    fn_format = guess_input_format(fn, format)
+                    key = None
+                    if cache is not None and hash != 'none':
+                        key = cache.file_key(fn)
+                        rdf_hash = cache.get(key, fn_format, hash)
+                        if rdf_hash is not None:
+                            results[index] = (fn, rdf_hash, None)
+                            continue
+                except Exception as exc:
+                    results[index] = (fn, None, exc)
+                    continue
+                future = executor.submit(hash_file, fn, format=fn_format, hash=hash, memory_limit=memory_limit,
+                                         tmp_dir=tmp_dir)
+                pending[future] = (index, fn, key, fn_format)
+
+            if pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    index, fn, key, fn_format = pending.pop(future)
+                    try:
+                        rdf_hash = future.result()
+                    except Exception as exc:
+                        results[index] = (fn, None, exc)
+                        continue
+                    if key is not None:
+                        cache.put(key, fn_format, hash, rdf_hash)
+                    results[index] = (fn, rdf_hash, None)
+
+            if ordered:
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+            else:
+                for index in list(results):
+                    yield results.pop(index)
+
+
+def hash_file(file_name, format="auto", hash="sha256", jobs=1, memory_limit=None, tmp_dir=None, cache=None):
+    """
+    Computes hash of the RDF graph in file file_name ('-' for stdin).
+    When memory_limit is given, N-Triples and N-Quads files are hashed out-of-core
+    using at most about memory_limit bytes for sorting.
+    When cache (HashCache) is given, hashes of unchanged files are taken from it.
+    """
+    stdin = is_stdin(file_name)
+    format = guess_input_format(file_name, format)
+
+    if cache is None or stdin or hash == 'none':
+        return _hash_file(file_name, stdin, format, hash, jobs, memory_limit, tmp_dir)
+
+    key = cache.file_key(file_name)
+    rdf_hash = cache.get(key, format, hash)
+    if rdf_hash is None:
+        rdf_hash = _hash_file(file_name, stdin, format, hash, jobs, memory_limit, tmp_dir)
+        cache.put(key, format, hash, rdf_hash)
+    return rdf_hash
+
+
+def _hash_file(file_name, stdin, format, hash, jobs, memory_limit, tmp_dir):
+    if memory_limit is not None and format in STREAM_FORMATS:
+        if stdin:
+            return calc_file_hash_digest(sys.stdin.buffer, hash=hash, memory_limit=memory_limit, tmp_dir=tmp_dir)
+        with open_graph_file(file_name) as fd:
+            return calc_file_hash_digest(fd, hash=hash, memory_limit=memory_limit, tmp_dir=tmp_dir)
+
+    if format in QUAD_FORMATS:
+        graph = rdflib.Dataset(default_union=True)
+    else:
         graph = rdflib.Graph()
+    if stdin:
+        data = sys.stdin.read()
         graph.parse(data=data, format=format)
     else:
-        if format == 'auto':
-            format = rdflib.util.guess_format(file_name)
-        graph = rdflib.Graph()
-        graph.parse(file_name, format=format)
-    rdf_hash = calc_hash_value(graph)
-    if hash != 'none':
-        hash_func = hashlib.new(hash)
-        hash_func.update(rdf_hash.encode('utf-8'))
-        rdf_hash = hash_func.hexdigest()
-    return rdf_hash
-
+        with open_graph_file(file_name) as fd:
+            graph.parse(source=fd, format=format)
+    return calc_hash_digest(graph, hash=hash, jobs=jobs)
 
-if __name__ == "__main__":
 
+def main():
     parser = argparse.ArgumentParser(
         description="Compute hash from RDF graph",
         epilog="supported RDF file formats: {}".format(', '.join(['auto'] + INPUT_FORMATS))
@@ -47,15 +295,69 @@ if __name__ == "__main__":
                         choices=['auto'] + INPUT_FORMATS,
                         default="auto",
                         help="input RDF format")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int,
+                        default=1,
+                        help="number of processes, files are hashed in parallel, "
+                             "a single file is hashed by sharding its graph")
+    parser.add_argument("-u", "--unordered", action="store_true",
+                        help="print hashes in order of completion instead of order of files")
+    parser.add_argument("-f", "--files-from", metavar="LIST",
+                        help="read names of files to hash from LIST, one per line ('-' for stdin)")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="hash all files in directories given as FILE")
+    parser.add_argument("-m", "--memory-limit", metavar="SIZE", type=parse_size,
+                        help="hash N-Triples and N-Quads out-of-core, sorting with at most SIZE "
+                             "bytes (K, M, G suffixes allowed) in memory")
+    parser.add_argument("-T", "--tmp-dir", metavar="DIR",
+                        help="directory for temporary files of out-of-core hashing")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not use the persistent hash cache")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        default=DEFAULT_CACHE_DIR,
+                        help="directory of the persistent hash cache")
+    parser.add_argument("--cache-max-age", metavar="DAYS", type=float,
+                        default=30,
+                        help="evict cache entries not used for DAYS days")
+    parser.add_argument("--cache-max-entries", metavar="N", type=int,
+                        default=1000000,
+                        help="keep at most N most recently used cache entries")
     parser.add_argument("--version", action="version",
                         version="%(prog)s 0.1")
-    parser.add_argument('files', metavar='FILE', type=str, nargs='+',
+    parser.add_argument('files', metavar='FILE', type=str, nargs='*',
                         help='RDF files')
     args = parser.parse_args(sys.argv[1:])
+    if not args.files and args.files_from is None:
+        parser.error("no files to hash")
 
     logging.basicConfig()
 
     # Configure application
-    for fn in args.files:
-        hash_value = hash_file(fn, format=args.input_format, hash=args.hash)
-        print("{}  {}".format(hash_value, fn))
+    cache = None
+    if not args.no_cache:
+        cache = HashCache(args.cache_dir, max_age=args.cache_max_age * 24 * 60 * 60,
+                          max_entries=args.cache_max_entries)
+    file_names = list(iter_input_files(args.files, files_from=args.files_from, recursive=args.recursive))
+    options = dict(format=args.input_format, hash=args.hash, memory_limit=args.memory_limit, tmp_dir=args.tmp_dir,
+                   cache=cache)
+    if len(file_names) == 1:
+        # Use all processes for the single graph
+        results = hash_files(file_names, graph_jobs=args.jobs, **options)
+    else:
+        results = hash_files(file_names, jobs=args.jobs, ordered=not args.unordered, **options)
+
+    num_failed = 0
+    try:
+        for fn, hash_value, exc in results:
+            if exc is not None:
+                num_failed += 1
+                print('hashing of file %s failed, exception: %s' % (fn, exc), file=sys.stderr)
+            else:
+                print("{}  {}".format(hash_value, fn))
+    finally:
+        if cache is not None:
+            cache.close()
+    return 1 if num_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
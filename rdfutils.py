@@ -1,4 +1,14 @@
+import hashlib
+import heapq
+import itertools
+import marshal
+import operator
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import rdflib
+from rdflib.exceptions import ParserError as ParseError
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser, r_tail, r_wspace
 
 
 def get_reachable_statements(node, graph, seen=None):
@@ -47,73 +57,627 @@ def replace_uri_base(stmts, old_base, new_base):
 # http://publica.fraunhofer.de/documents/N-326390.html
 
 
-SUBJECT_START = u'{'
-SUBJECT_END = u'}'
-PROPERTY_START = u'('
-PROPERTY_END = u')'
-OBJECT_START = u'['
-OBJECT_END = u']'
-BLANK_NODE = u'*'
+SUBJECT_START = '{'
+SUBJECT_END = '}'
+PROPERTY_START = '('
+PROPERTY_END = ')'
+OBJECT_START = '['
+OBJECT_END = ']'
+BLANK_NODE = '*'
+
+# Number of shards per worker process of parallel hashing, more shards balance the load better
+SHARDS_PER_JOB = 4
+
+
+def calc_hash_value(g, jobs=1):
+    return ''.join(iter_hash_value(g, jobs=jobs))
+
+
+def iter_hash_value(g, jobs=1):
+    """
+    Yields the canonical string of the graph piece by piece, one subject at a time.
+    Concatenation of all pieces is equal to calc_hash_value(g).
+    """
+    for s in encode_subjects(g, jobs=jobs):
+        yield SUBJECT_START + s + SUBJECT_END
+
+
+def update_hash(hash_func, g, jobs=1):
+    """
+    Feeds the canonical string of the graph into hash_func (a hashlib object)
+    without building the whole string in memory.
+    :return: hash_func
+    """
+    for s in iter_hash_value(g, jobs=jobs):
+        hash_func.update(s.encode('utf-8'))
+    return hash_func
+
+
+def calc_hash_digest(g, hash='sha256', jobs=1):
+    """
+    Computes hex digest of the canonical string of the graph with hash function hash.
+    When hash is 'none' the canonical string itself is returned.
+    """
+    if hash == 'none':
+        return calc_hash_value(g, jobs=jobs)
+    return update_hash(hashlib.new(hash), g, jobs=jobs).hexdigest()
+
+
+def encode_subjects(g, jobs=1):
+    """
+    Reads all statements of the graph once into a property table. Subjects
+    without blank node objects (all subjects of a graph without blank nodes)
+    are encoded directly from the table, only blank nodes and subjects
+    referring to them are encoded by the full traversal.
+
+    With jobs > 1 subjects are split into shards which are encoded by a pool
+    of jobs processes, the sorted shards are merged afterwards.
+    :return: encoded strings of all subject nodes in sorted order
+    """
+    table = property_table(g)
+    if jobs is None or jobs <= 1 or len(table) < 2:
+        return _encode_shard(list(table), table)
 
+    num_shards = min(len(table), jobs * SHARDS_PER_JOB)
+    shards = [[] for _ in range(num_shards)]
+    for i, ns in enumerate(table):
+        shards[i % num_shards].append(ns)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_encode_shard, subjects, _shard_table(subjects, table))
+                   for subjects in shards]
+        results = [future.result() for future in futures]
+    return heapq.merge(*results)
 
-def calc_hash_value(g):
-    subject_strings = []
-    seen_subject = {}
-    for ns in g.subjects():  # All subject nodes
-        if ns in seen_subject:
+
+def _shard_table(subjects, table):
+    """
+    :return: part of the property table required to encode subjects,
+             i.e. properties of subjects and of all blank nodes reachable from them
+    """
+    shard = {}
+    stack = list(subjects)
+    while stack:
+        ns = stack.pop()
+        if ns in shard:
             continue
-        else:
-            seen_subject[ns] = 1
-        visited_nodes = {}
-        subject_strings.append(encode_subject(ns, visited_nodes, g))
+        properties = table.get(ns)
+        if properties is None:
+            continue
+        shard[ns] = properties
+        for objects in properties.values():
+            for no in objects:
+                if isinstance(no, rdflib.BNode) and no not in shard:
+                    stack.append(no)
+    return shard
+
+
+def _encode_shard(subjects, table):
+    """
+    :return: sorted list of encoded strings of subjects
+    """
+    subject_strings = [_encode_table_subject(ns, table) for ns in subjects]
     subject_strings.sort()
-    result = unicode()
-    for s in subject_strings:
-        result += SUBJECT_START + s + SUBJECT_END
-    return result
+    return subject_strings
+
+
+def _encode_table_subject(ns, table):
+    properties = table[ns]
+    if isinstance(ns, rdflib.BNode) or _has_blank_objects(properties):
+        visited_nodes = {}
+        return _encode_subject(ns, visited_nodes, table.get)
+    return _encode_ground(ns, properties)
+
+
+def property_table(g):
+    """
+    :return: dictionary mapping each subject to a dictionary of its predicates
+             and their (distinct) objects
+    """
+    table = {}
+    for ns, iri, no in g.triples((None, None, None)):
+        properties = table.get(ns)
+        if properties is None:
+            properties = table[ns] = {}
+        objects = properties.get(iri)
+        if objects is None:
+            objects = properties[iri] = {}
+        objects[no] = 1
+    return table
 
 
 def encode_subject(ns, visited_nodes, g):
+    return _encode_subject(ns, visited_nodes, lambda n: _node_properties(n, g))
+
+
+def _encode_subject(ns, visited_nodes, lookup):
     if isinstance(ns, rdflib.BNode):
         if ns in visited_nodes:
-            return unicode()  # This path terminates
-        else:
-            visited_nodes[ns] = 1  # Record that we visited this node
-            result = BLANK_NODE
+            return ''  # This path terminates
+        visited_nodes[ns] = 1  # Record that we visited this node
+        head = BLANK_NODE
     else:
-        result = ns.toPython()  # ns has to be a IRI
-    result += encode_properties(ns, visited_nodes, g)
-    return result
+        head = ns.toPython()  # ns has to be a IRI
+    return _encode_node(head, ns, visited_nodes, lookup)
 
 
 def encode_properties(ns, visited_nodes, g):
-    p = sorted(g.predicates(subject=ns), key=lambda x: x.toPython())
-    result = unicode()
-    #object_strings = []
-    seen_iri = {}
-    for iri in p:
-        if iri in seen_iri:
-            continue
-        seen_iri[iri] = 1
-        object_strings = []
-        result += PROPERTY_START + iri.toPython()
-        seen_no = {}
-        for no in g.objects(subject=ns, predicate=iri):  # All objects for ns and iri
-            if no in seen_no:
-                continue
-            seen_no[no] = 1
-            object_strings.append(encode_object(no, visited_nodes, g))
-        object_strings.sort()
-        for o in object_strings:
-            result += OBJECT_START + o + OBJECT_END
-        result += PROPERTY_END
-    return result
+    return _encode_node('', ns, visited_nodes, lambda n: _node_properties(n, g))
 
 
 def encode_object(no, visited_nodes, g):
     if isinstance(no, rdflib.BNode):
         return encode_subject(no, visited_nodes, g)  # Re-enter Algorithm 2
     elif isinstance(no, rdflib.Literal):
+        if no.datatype is None:
+            return no.n3()  # Plain literals are already in normal form
         return no.normalize().n3()  # Consider language and type
     else:
         return no.toPython()  # no has to be a IRI
+
+
+class _NodeEncoder(object):
+    """
+    Encodes properties of a single node. Blank node objects are not encoded
+    recursively, instead step() returns them to the caller which keeps
+    an explicit stack of encoders.
+
+    A property with a single object needs no sorting, so the encoding of
+    such an object is written directly to the parts of the node.
+    """
+
+    __slots__ = ('parts', 'properties', 'objects', 'object_strings')
+
+    def __init__(self, head, properties, parts=None):
+        self.parts = [] if parts is None else parts
+        self.parts.append(head)
+        self.properties = iter(_sorted_properties(properties))
+        self.objects = None  # Objects of the current property
+        self.object_strings = None
+
+    @property
+    def inline(self):
+        """True if objects of the current property are written directly to parts"""
+        return self.object_strings is None
+
+    def step(self):
+        """
+        :return: next blank node object to encode or None when all properties are encoded
+        """
+        while True:
+            if self.objects is not None:
+                for no in self.objects:
+                    if isinstance(no, rdflib.BNode):
+                        return no
+                    self.add_object(encode_object(no, None, None))
+                self.close_property()
+            try:
+                iri, objects = next(self.properties)
+            except StopIteration:
+                return None
+            self.parts.append(PROPERTY_START + iri.toPython())
+            self.objects = iter(objects)
+            self.object_strings = None if len(objects) == 1 else []
+
+    def add_object(self, o):
+        if self.inline:
+            self.parts.append(OBJECT_START + o + OBJECT_END)
+        else:
+            self.object_strings.append(o)
+
+    def close_property(self):
+        if self.object_strings is not None:
+            self.object_strings.sort()
+            for o in self.object_strings:
+                self.parts.append(OBJECT_START + o + OBJECT_END)
+        self.parts.append(PROPERTY_END)
+
+
+def _node_properties(ns, g):
+    """
+    :return: dictionary mapping predicates of node ns to their (distinct) objects
+    """
+    properties = {}
+    for iri, no in g.predicate_objects(ns):
+        objects = properties.get(iri)
+        if objects is None:
+            objects = properties[iri] = {}
+        objects[no] = 1
+    return properties
+
+
+def _sorted_properties(properties):
+    """
+    :return: list of (predicate, objects) pairs sorted by predicate
+    """
+    if properties is None:
+        return []
+    return sorted(properties.items(), key=lambda x: x[0].toPython())
+
+
+def _has_blank_objects(properties):
+    for objects in properties.values():
+        for no in objects:
+            if isinstance(no, rdflib.BNode):
+                return True
+    return False
+
+
+def _encode_ground(ns, properties):
+    """
+    Encodes IRI subject ns, none of its objects may be a blank node.
+    """
+    parts = [ns.toPython()]
+    for iri, objects in _sorted_properties(properties):
+        parts.append(PROPERTY_START + iri.toPython())
+        for o in sorted(encode_object(no, None, None) for no in objects):
+            parts.append(OBJECT_START + o + OBJECT_END)
+        parts.append(PROPERTY_END)
+    return ''.join(parts)
+
+
+def _encode_node(head, ns, visited_nodes, lookup):
+    """
+    :param lookup: function returning the dictionary of properties of a node
+    """
+    stack = [_NodeEncoder(head, lookup(ns))]
+    while True:
+        encoder = stack[-1]
+        no = encoder.step()
+        if no is None:
+            stack.pop()
+            if not stack:
+                return ''.join(encoder.parts)
+            parent = stack[-1]
+            if encoder.parts is parent.parts:
+                parent.parts.append(OBJECT_END)
+            else:
+                parent.add_object(''.join(encoder.parts))
+        elif no in visited_nodes:
+            encoder.add_object('')  # This path terminates
+        else:
+            visited_nodes[no] = 1  # Record that we visited this node
+            if encoder.inline:
+                encoder.parts.append(OBJECT_START)
+                stack.append(_NodeEncoder(BLANK_NODE, lookup(no), encoder.parts))
+            else:
+                stack.append(_NodeEncoder(BLANK_NODE, lookup(no)))
+
+
+class IncrementalHash(object):
+    """
+    Order-independent hash of a graph which can be updated when statements are
+    added or removed. Hash of each subject is the hash of its encoding
+    SUBJECT_START + encode_subject() + SUBJECT_END, hash of the graph is the sum
+    of all subject hashes modulo 2 ** bits of the hash function. An update only
+    re-encodes subjects of changed statements and subjects from which they are
+    reachable through blank nodes.
+
+    Note that the value differs from calc_hash_digest, which hashes the sorted
+    concatenation of subject encodings.
+    """
+
+    def __init__(self, g, hash='sha256'):
+        self.graph = g
+        self.hash = hash
+        self.modulus = 2 ** (8 * hashlib.new(hash).digest_size)
+        self.digests = {}  # subject -> hash of subject encoding
+        self.value = 0
+        table = property_table(g)
+        for ns in table:
+            self._set_digest(ns, _encode_table_subject(ns, table))
+
+    def add(self, triples):
+        """
+        Adds triples to the graph and updates the hash.
+        """
+        self.update(added=triples)
+
+    def remove(self, triples):
+        """
+        Removes triples from the graph and updates the hash.
+        """
+        self.update(removed=triples)
+
+    def update(self, added=(), removed=()):
+        """
+        Removes triples removed from the graph, then adds triples added and updates the hash.
+        """
+        added = list(added)
+        removed = list(removed)
+        subjects = set(s for s, _, _ in added)
+        subjects.update(s for s, _, _ in removed)
+        affected = _blank_ancestors(subjects, self.graph)
+        for triple in removed:
+            self.graph.remove(triple)
+        for triple in added:
+            self.graph.add(triple)
+        affected.update(_blank_ancestors(subjects, self.graph))
+        for ns in affected:
+            if (ns, None, None) in self.graph:
+                visited_nodes = {}
+                self._set_digest(ns, encode_subject(ns, visited_nodes, self.graph))
+            else:
+                self._set_digest(ns, None)
+
+    def hexdigest(self):
+        return '%0*x' % (2 * hashlib.new(self.hash).digest_size, self.value)
+
+    def _set_digest(self, ns, encoding):
+        digest = self.digests.pop(ns, None)
+        if digest is not None:
+            self.value = (self.value - digest) % self.modulus
+        if encoding is not None:
+            hash_func = hashlib.new(self.hash)
+            hash_func.update((SUBJECT_START + encoding + SUBJECT_END).encode('utf-8'))
+            digest = int(hash_func.hexdigest(), 16)
+            self.digests[ns] = digest
+            self.value = (self.value + digest) % self.modulus
+
+
+def _blank_ancestors(nodes, g):
+    """
+    :return: set of nodes and of all subjects from which they are reachable through blank nodes
+    """
+    result = set()
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if node in result:
+            continue
+        result.add(node)
+        if isinstance(node, rdflib.BNode):
+            stack.extend(g.subjects(None, node))
+    return result
+
+
+# Out-of-core hashing of N-Triples and N-Quads files. Statements are sorted
+# externally by subject, so only the description of one subject and the
+# descriptions of blank nodes have to be kept in memory.
+
+# Default limit of memory used by sort buffers, in bytes
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+
+# Maximal number of sorted runs merged at once
+MAX_MERGE_RUNS = 64
+
+# Estimated memory used by a sort record in addition to its strings
+RECORD_OVERHEAD = 256
+
+
+def iter_file_hash_value(f, memory_limit=DEFAULT_MEMORY_LIMIT, tmp_dir=None):
+    """
+    Yields the canonical string of the graph stored in N-Triples or N-Quads
+    file f piece by piece, like iter_hash_value. Graph names of quads are
+    ignored, i.e. the union of all graphs is hashed.
+    :param f: file object
+    :param memory_limit: memory in bytes used for sorting before spilling to temporary files
+    :param tmp_dir: directory of temporary files
+    """
+    statements = ExternalSorter(memory_limit, tmp_dir)
+    subject_strings = ExternalSorter(memory_limit, tmp_dir)
+    try:
+        sink = _StatementSink(statements)
+        _StatementParser(sink).parse(f)
+
+        for s, records in itertools.groupby(statements, key=operator.itemgetter(0)):
+            subject_strings.add(_encode_records(s, records, sink.blank_table))
+        for ns in sink.blank_table:
+            visited_nodes = {}
+            subject_strings.add(_encode_subject(ns, visited_nodes, sink.blank_table.get))
+        sink.blank_table = None
+        statements.close()
+
+        for s in subject_strings:
+            yield SUBJECT_START + s + SUBJECT_END
+    finally:
+        statements.close()
+        subject_strings.close()
+
+
+def count_file_statements(f, memory_limit=DEFAULT_MEMORY_LIMIT, tmp_dir=None):
+    """
+    Counts distinct statements of N-Triples or N-Quads file f, statements repeated with other
+    whitespace, escapes or lexical forms of literals are counted once. Graph names of quads are ignored.
+    :param memory_limit: memory in bytes used for sorting before spilling to temporary files
+    :return: number of distinct statements
+    """
+    statements = ExternalSorter(memory_limit, tmp_dir)
+    try:
+        _StatementParser(_StatementKeys(statements)).parse(f)
+        return sum(1 for _ in itertools.groupby(statements))
+    finally:
+        statements.close()
+
+
+def calc_file_hash_digest(f, hash='sha256', memory_limit=DEFAULT_MEMORY_LIMIT, tmp_dir=None):
+    """
+    Computes hex digest of the canonical string of the graph stored in N-Triples
+    or N-Quads file f, equal to calc_hash_digest of the parsed graph.
+    When hash is 'none' the canonical string itself is returned.
+    """
+    pieces = iter_file_hash_value(f, memory_limit=memory_limit, tmp_dir=tmp_dir)
+    if hash == 'none':
+        return ''.join(pieces)
+    hash_func = hashlib.new(hash)
+    for s in pieces:
+        hash_func.update(s.encode('utf-8'))
+    return hash_func.hexdigest()
+
+
+class ExternalSorter(object):
+    """
+    Sorts strings or tuples of strings which do not fit in memory. Records are
+    collected until memory_limit is reached, then they are sorted and written
+    as a run to a temporary file. Iteration merges all runs.
+    """
+
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT, tmp_dir=None):
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.records = []
+        self.size = 0
+        self.runs = []
+
+    def add(self, record):
+        self.records.append(record)
+        if isinstance(record, tuple):
+            self.size += RECORD_OVERHEAD + sum(len(i) for i in record if i is not None)
+        else:
+            self.size += RECORD_OVERHEAD + len(record)
+        if self.size >= self.memory_limit:
+            self._spill()
+
+    def __iter__(self):
+        self.records.sort()
+        if not self.runs:
+            return iter(self.records)
+        while len(self.runs) > MAX_MERGE_RUNS:
+            runs = self.runs[:MAX_MERGE_RUNS]
+            del self.runs[:MAX_MERGE_RUNS]
+            self.runs.append(self._write_run(heapq.merge(*[_read_run(i) for i in runs])))
+            for i in runs:
+                i.close()
+        return heapq.merge(self.records, *[_read_run(i) for i in self.runs])
+
+    def close(self):
+        for i in self.runs:
+            i.close()
+        self.runs = []
+        self.records = []
+        self.size = 0
+
+    def _spill(self):
+        self.records.sort()
+        self.runs.append(self._write_run(self.records))
+        self.records = []
+        self.size = 0
+
+    def _write_run(self, records):
+        f = tempfile.TemporaryFile(dir=self.tmp_dir)
+        for record in records:
+            marshal.dump(record, f)
+        f.seek(0)
+        return f
+
+
+def _read_run(f):
+    while True:
+        try:
+            yield marshal.load(f)
+        except EOFError:
+            return
+
+
+class _EncodedObject(str):
+    """
+    Object node which is already encoded, encode_object returns the encoding itself.
+    """
+
+    def toPython(self):
+        return self
+
+
+class _StatementSink(object):
+    """
+    Receives statements from the parser. Descriptions of blank nodes are kept
+    in blank_table, statements about IRIs are added to the sorter as records
+    (subject, predicate, object key, encoded object). Encoded object is None
+    for blank nodes.
+    """
+
+    def __init__(self, sorter):
+        self.sorter = sorter
+        self.blank_table = {}
+
+    def triple(self, s, p, o):
+        if isinstance(s, rdflib.BNode):
+            properties = self.blank_table.get(s)
+            if properties is None:
+                properties = self.blank_table[s] = {}
+            objects = properties.get(p)
+            if objects is None:
+                objects = properties[p] = {}
+            objects[o] = 1
+        elif isinstance(o, rdflib.BNode):
+            self.sorter.add((s.toPython(), p.toPython(), o.n3(), None))
+        else:
+            self.sorter.add((s.toPython(), p.toPython(), o.n3(), encode_object(o, None, None)))
+
+
+class _StatementKeys(object):
+    """
+    Receives statements from the parser and adds them to the sorter as records (subject, predicate, object).
+    """
+
+    def __init__(self, sorter):
+        self.sorter = sorter
+
+    def triple(self, s, p, o):
+        self.sorter.add((s.n3(), p.n3(), o.n3()))
+
+
+def _encode_records(s, records, blank_table):
+    """
+    Encodes IRI subject s from its sorted records.
+    """
+    properties = {}
+    has_blank_objects = False
+    previous = None
+    for record in records:
+        if record == previous:
+            continue  # Duplicate statement
+        previous = record
+        _, iri, key, o = record
+        objects = properties.get(iri)
+        if objects is None:
+            objects = properties[iri] = []
+        if o is None:
+            has_blank_objects = True
+            objects.append(rdflib.BNode(key[2:]))
+        else:
+            objects.append(_EncodedObject(o))
+    if not has_blank_objects:
+        parts = [s]
+        for iri in sorted(properties):
+            parts.append(PROPERTY_START + iri)
+            for o in sorted(properties[iri]):
+                parts.append(OBJECT_START + o + OBJECT_END)
+            parts.append(PROPERTY_END)
+        return ''.join(parts)
+
+    properties = dict((rdflib.URIRef(iri), objects) for iri, objects in properties.items())
+    ns = rdflib.URIRef(s)
+
+    def lookup(node):
+        if node == ns:
+            return properties
+        return blank_table.get(node)
+
+    return _encode_subject(ns, {}, lookup)
+
+
+class _StatementParser(W3CNTriplesParser):
+    """
+    N-Triples parser which also accepts N-Quads lines and ignores their graph names.
+    """
+
+    def parseline(self, bnode_context=None):
+        self.eat(r_wspace)
+        if (not self.line) or self.line.startswith('#'):
+            return  # The line is empty or a comment
+
+        subject = self.subject(bnode_context)
+        self.eat(r_wspace)
+
+        predicate = self.predicate()
+        self.eat(r_wspace)
+
+        obj = self.object(bnode_context)
+        self.eat(r_wspace)
+
+        self.uriref() or self.nodeid(bnode_context)  # Graph name
+        self.eat(r_tail)
+
+        if self.line:
+            raise ParseError("Trailing garbage: {}".format(self.line))
+        self.sink.triple(subject, predicate, obj)
@@ -0,0 +1,479 @@
+import argparse
+import collections
+import heapq
+import random
+import threading
+import time
+
+import concurrent.futures
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import queue
+from urllib.parse import urlsplit
+
+from metricsutils import collect_latencies, record, set_graph
+
+MAX_WORKERS = 5
+try:
+    import multiprocessing
+
+    MAX_WORKERS = multiprocessing.cpu_count() * 5
+except (ImportError, NotImplementedError):
+    pass
+
+DEFAULT_NUM_TRIALS = 3
+
+# Delay before the first retry in seconds, doubled for every further retry up to MAX_BACKOFF
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# Maximal and initial number of concurrent tasks per endpoint
+DEFAULT_ENDPOINT_LIMIT = 16
+INITIAL_ENDPOINT_LIMIT = 4
+
+# Latency may exceed the lowest observed latency by this factor while concurrency is increased
+LATENCY_TOLERANCE = 0.5
+
+# Weight of a new latency sample in the moving average
+LATENCY_SMOOTHING = 0.2
+
+# HTTP status codes of client errors which are worth retrying
+RETRYABLE_CLIENT_ERRORS = (408, 425, 429)
+
+# Execution engines of the dataset tools, see add_scheduler_arguments
+ENGINES = ('thread', 'async')
+
+# Seconds between checks for new tasks while an iterator of tasks is not exhausted
+FEED_POLL_INTERVAL = 0.05
+
+# Seconds to wait when no task is running and no retry or new task is due
+IDLE_INTERVAL = 0.1
+
+# Orders in which tasks are started, see TaskScheduler and add_scheduler_arguments
+ORDERS = ('auto', 'largest', 'listed')
+
+# Default size from which graphs count as huge, in the units of the tool, and number of huge graphs at a time
+DEFAULT_HUGE_SIZES = {'triples': 10000000, 'bytes': 1024 * 1024 * 1024}
+DEFAULT_HUGE_LIMIT = 2
+
+# Pseudo endpoint of all huge tasks limiting how many of them run at a time
+HUGE_TASKS = 'huge tasks'
+
+
+def is_retryable(exc):
+    """
+    Server errors, timeouts and connection errors are retried, client errors
+    (4xx) are not, except for 408, 425 and 429. Other exceptions are retried.
+    """
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        return status >= 500 or status in RETRYABLE_CLIENT_ERRORS
+    return True
+
+
+def is_overload(exc):
+    """
+    :return: True if exc indicates that the server is overloaded
+    """
+    if isinstance(exc, (requests.Timeout, requests.ConnectionError)):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code >= 500 or exc.response.status_code in RETRYABLE_CLIENT_ERRORS
+    return False
+
+
+def retry_after(exc):
+    """
+    :return: delay in seconds requested by the Retry-After header of the failed response or None
+    """
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        value = exc.response.headers.get('retry-after')
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+def backoff_delay(trial, backoff=DEFAULT_BACKOFF, max_backoff=MAX_BACKOFF):
+    """
+    :return: exponential backoff delay with full jitter before the retry following trial number trial
+    """
+    return random.uniform(0, min(max_backoff, backoff * 2 ** (trial - 1)))
+
+
+def task_endpoints(*urls):
+    """
+    :return: endpoints (scheme and host) of urls, used as Task.endpoints
+    """
+    endpoints = []
+    for url in urls:
+        parts = urlsplit(url)
+        endpoint = parts.scheme + '://' + parts.netloc
+        if endpoint not in endpoints:
+            endpoints.append(endpoint)
+    return tuple(endpoints)
+
+
+def task_graph(task):
+    """
+    :return: name of the graph of task for metrics, tasks name it graph or graph_name
+    """
+    graph = getattr(task, 'graph', None)
+    if graph is None:
+        graph = getattr(task, 'graph_name', None)
+    return graph
+
+
+class AdaptiveLimit(object):
+    """
+    AIMD concurrency limit of a single endpoint. The limit grows by one per limit
+    successful tasks while the smoothed latency stays within LATENCY_TOLERANCE
+    of the lowest smoothed latency observed, and is halved on overload errors.
+    Latency is the time to first byte of requests rather than the duration of tasks,
+    which depends on the size of their graphs more than on the load of the server.
+    Without adaptive the limit is fixed to maximum.
+    """
+
+    def __init__(self, maximum=DEFAULT_ENDPOINT_LIMIT, initial=INITIAL_ENDPOINT_LIMIT, adaptive=True):
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.limit = float(min(initial, maximum) if adaptive else maximum)
+        self.in_flight = 0
+        self.latency = None
+        self.min_latency = None
+
+    def available(self):
+        return self.in_flight < int(self.limit)
+
+    def acquire(self):
+        self.in_flight += 1
+
+    def release(self, latency, exc=None):
+        self.in_flight -= 1
+        if not self.adaptive:
+            return
+        if exc is not None:
+            if is_overload(exc):
+                self.limit = max(1.0, self.limit / 2)
+            return
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        if self.min_latency is None or self.latency < self.min_latency:
+            self.min_latency = self.latency
+        if self.latency <= self.min_latency * (1 + LATENCY_TOLERANCE):
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+
+class TaskScheduler(object):
+    """
+    Runs tasks in a thread pool. Task is an object with method run() and attribute
+    endpoints, a sequence of endpoint names (see task_endpoints) the task connects to.
+    A task is started only when all of its endpoints are below their concurrency
+    limit. Failed tasks are retried after an exponential backoff with jitter, up to
+    num_trials runs, when is_retryable() allows it.
+    Tasks may have attribute size (e.g. number of triples of a graph, None when unknown).
+    With order 'largest' or 'auto' a list of tasks is started largest first, so that a huge
+    graph does not start last and stretch the run, tasks of an iterator are always started in
+    order. The orders differ only in the tools, which list sizes of graphs for 'largest'
+    alone. At most huge_limit tasks of at least huge_size run at a time.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, num_trials=DEFAULT_NUM_TRIALS, backoff=DEFAULT_BACKOFF,
+                 endpoint_limit=DEFAULT_ENDPOINT_LIMIT, adaptive=True, order='listed', huge_size=None,
+                 huge_limit=DEFAULT_HUGE_LIMIT):
+        self.max_workers = max_workers
+        self.num_trials = num_trials
+        self.backoff = backoff
+        self.endpoint_limit = endpoint_limit
+        self.adaptive = adaptive
+        self.order = order
+        self.huge_size = huge_size
+        self.limits = {HUGE_TASKS: AdaptiveLimit(huge_limit, adaptive=False)}  # endpoint -> AdaptiveLimit
+
+    def task_endpoints(self, task):
+        """
+        :return: endpoints of task including HUGE_TASKS for huge tasks
+        """
+        size = getattr(task, 'size', None)
+        if self.huge_size is not None and size is not None and size >= self.huge_size:
+            return tuple(task.endpoints) + (HUGE_TASKS,)
+        return tuple(task.endpoints)
+
+    def limit(self, endpoint):
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            limit = self.limits[endpoint] = AdaptiveLimit(self.endpoint_limit, adaptive=self.adaptive)
+        return limit
+
+    def run(self, tasks, on_progress=None, on_error=None):
+        """
+        Runs all tasks. Tasks is a list or an iterator, tasks of an iterator are started while
+        it still produces further tasks, e.g. while the graphs of a dataset are enumerated.
+        :param on_progress: function (number of finished tasks, number of tasks, task) called after a task
+                            finished successfully or for the last time
+        :param on_error: function (task, exception, trial, will be retried) called after each failure
+        :return: tuple (list of successful tasks, list of failed tasks)
+        """
+        state = _SchedulerState(self, tasks, on_progress, on_error)
+        running = {}  # future -> (task, start time)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while state.pending() or running:
+                while len(running) < self.max_workers:
+                    task = state.next_task()
+                    if task is None:
+                        break
+                    running[executor.submit(_run_task, task)] = (task, time.time())
+
+                timeout = state.timeout()
+                if not running:
+                    time.sleep(IDLE_INTERVAL if timeout is None else timeout)
+                    continue
+                finished, _ = concurrent.futures.wait(running, timeout=timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task, start = running.pop(future)
+                    exc = future.exception()
+                    state.finish(task, time.time() - start, exc, None if exc is not None else future.result())
+
+        return state.done_tasks, state.failed_tasks
+
+
+def _run_task(task):
+    """
+    Runs task in a worker thread, requests of the task are recorded for its graph.
+    :return: times to first byte of the requests of the task by endpoint
+    """
+    set_graph(task_graph(task))
+    latencies = collect_latencies()
+    task.run()
+    return latencies
+
+
+class _TaskFeed(object):
+    """
+    Takes tasks from an iterator in a background thread, so that blocking iterators do not stall the scheduler.
+    """
+
+    _END = object()
+
+    def __init__(self, tasks):
+        self.queue = queue.Queue()
+        self.exc = None
+        self.finished = False
+        thread = threading.Thread(target=self._produce, args=(tasks,))
+        thread.daemon = True
+        thread.start()
+
+    def _produce(self, tasks):
+        try:
+            for task in tasks:
+                self.queue.put(task)
+        except Exception as e:
+            self.exc = e
+        self.queue.put(self._END)
+
+    def take(self):
+        """
+        :return: list of tasks produced since the last call, exceptions of the iterator are raised
+        """
+        tasks = []
+        while not self.finished:
+            try:
+                task = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if task is self._END:
+                self.finished = True
+                if self.exc is not None:
+                    raise self.exc
+            else:
+                tasks.append(task)
+        return tasks
+
+
+class _SchedulerState(object):
+    """
+    Bookkeeping of a TaskScheduler run shared by all engines: tasks ready to start,
+    tasks waiting for a retry, number of trials and results. The total number of
+    tasks grows while tasks are taken from an iterator. Ready tasks are queued by
+    their endpoints, so that tasks waiting for a busy endpoint do not hold up tasks
+    of other endpoints.
+    """
+
+    def __init__(self, scheduler, tasks, on_progress, on_error):
+        self.scheduler = scheduler
+        self.ready = collections.OrderedDict()  # endpoints -> deque of (sequence number, task)
+        self.num_ready = 0
+        self.delayed = []  # heap of (time, sequence number, task)
+        self.trials = {}  # id(task) -> number of runs
+        self.done_tasks = []
+        self.failed_tasks = []
+        self.sequence = 0
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self.feed = None
+        if isinstance(tasks, (list, tuple)):
+            if scheduler.order in ('auto', 'largest'):
+                tasks = sorted(tasks, key=lambda task: -(getattr(task, 'size', None) or 0))
+            for task in tasks:
+                self.add_ready(task)
+        else:
+            self.feed = _TaskFeed(iter(tasks))
+        self.total = self.num_ready
+
+    def add_ready(self, task):
+        self.sequence += 1
+        endpoints = self.scheduler.task_endpoints(task)
+        waiting = self.ready.get(endpoints)
+        if waiting is None:
+            waiting = self.ready[endpoints] = collections.deque()
+        waiting.append((self.sequence, task))
+        self.num_ready += 1
+
+    def feeding(self):
+        """
+        :return: True while tasks are taken from an iterator which is not exhausted
+        """
+        if self.feed is None or self.feed.finished:
+            return False
+        tasks = self.feed.take()
+        for task in tasks:
+            self.add_ready(task)
+        self.total += len(tasks)
+        return not self.feed.finished
+
+    def pending(self):
+        feeding = self.feeding()
+        return bool(self.num_ready or self.delayed or feeding)
+
+    def next_task(self):
+        """
+        Takes the earliest ready task whose endpoints all have free capacity.
+        :return: task to start or None
+        """
+        self.feeding()
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.add_ready(heapq.heappop(self.delayed)[2])
+        best = None
+        best_limits = None
+        for endpoints, waiting in self.ready.items():
+            if not waiting or (best is not None and waiting[0][0] > best[0][0]):
+                continue
+            limits = [self.scheduler.limit(endpoint) for endpoint in endpoints]
+            if all(limit.available() for limit in limits):
+                best = waiting
+                best_limits = limits
+        if best is None:
+            return None
+        sequence, task = best.popleft()
+        self.num_ready -= 1
+        for limit in best_limits:
+            limit.acquire()
+        self.trials[id(task)] = self.trials.get(id(task), 0) + 1
+        return task
+
+    def timeout(self):
+        """
+        :return: seconds until the next delayed task is ready or new tasks are checked, or None
+        """
+        timeout = None
+        if self.delayed:
+            timeout = max(0.0, self.delayed[0][0] - time.time())
+        if self.feed is not None and not self.feed.finished:
+            timeout = FEED_POLL_INTERVAL if timeout is None else min(timeout, FEED_POLL_INTERVAL)
+        return timeout
+
+    def finish(self, task, latency, exc, latencies=None):
+        """
+        Records the result of a task run and schedules a retry if the task failed.
+        :param latency: duration of the task run
+        :param latencies: times to first byte of the requests of the task by endpoint, see collect_latencies()
+        """
+        scheduler = self.scheduler
+        for endpoint in scheduler.task_endpoints(task):
+            # Tasks without requests to the endpoint, e.g. with sessions which are not instrumented, use their duration
+            seconds = (latencies or {}).get(endpoint)
+            scheduler.limit(endpoint).release(sum(seconds) / len(seconds) if seconds else latency, exc)
+        record('task', task_graph(task), seconds=latency, trial=self.trials[id(task)],
+               error=None if exc is None else str(exc))
+        if exc is None:
+            self.done_tasks.append(task)
+        else:
+            trial = self.trials[id(task)]
+            retry = trial < scheduler.num_trials and is_retryable(exc)
+            if self.on_error is not None:
+                self.on_error(task, exc, trial, retry)
+            if retry:
+                delay = backoff_delay(trial, scheduler.backoff)
+                delay = max(delay, retry_after(exc) or 0)
+                self.sequence += 1
+                heapq.heappush(self.delayed, (time.time() + delay, self.sequence, task))
+                return
+            self.failed_tasks.append(task)
+        if self.on_progress is not None:
+            self.on_progress(len(self.done_tasks) + len(self.failed_tasks), self.total, task)
+
+
+def positive_int(value):
+    """
+    Parses a number of at least 1, e.g. a limit of concurrent tasks, with 0 no task could start
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number: {}".format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: {}".format(value))
+    return number
+
+
+def add_scheduler_arguments(parser, max_workers=MAX_WORKERS, size_unit='triples'):
+    """
+    Adds options of TaskScheduler to argparse parser. When max_workers is None the tool
+    has its own option for the number of workers and --max-workers is not added.
+    Sizes of tasks are numbers of size_unit, 'triples' or 'bytes'.
+    """
+    if max_workers is not None:
+        parser.add_argument('--max-workers', metavar='N', type=positive_int, default=max_workers,
+                            help='maximal number of concurrently running tasks')
+    parser.add_argument('--endpoint-limit', metavar='N', type=positive_int, default=DEFAULT_ENDPOINT_LIMIT,
+                        help='maximal number of concurrent requests to a single server')
+    parser.add_argument('--no-adaptive', action='store_true',
+                        help='always use --endpoint-limit concurrent requests instead of adapting '
+                             'concurrency to server latency and errors')
+    parser.add_argument('--trials', metavar='N', type=positive_int, default=DEFAULT_NUM_TRIALS,
+                        help='number of trials of each task')
+    parser.add_argument('--backoff', metavar='SECONDS', type=float, default=DEFAULT_BACKOFF,
+                        help='delay before the first retry, doubled for every further retry')
+    parser.add_argument('--order', choices=ORDERS, default='auto',
+                        help='start the largest graphs first when their sizes are known anyway, always start the '
+                             'largest graphs first, which requires counting triples of all graphs before the first '
+                             'graph starts, or start graphs in the order they are listed while they are listed')
+    parser.add_argument('--huge-size', metavar='N', type=int, default=DEFAULT_HUGE_SIZES[size_unit],
+                        help='number of %s from which graphs count as huge' % size_unit)
+    parser.add_argument('--huge-limit', metavar='N', type=positive_int, default=DEFAULT_HUGE_LIMIT,
+                        help='maximal number of huge graphs processed at a time')
+    parser.add_argument('--engine', choices=ENGINES, default='thread',
+                        help='run tasks in a thread pool or as coroutines on a single event loop '
+                             '(async, requires httpx), which can keep thousands of requests '
+                             'in flight when datasets consist of very many small graphs; raise --max-workers '
+                             'and --endpoint-limit accordingly')
+
+
+def create_scheduler_from_args(args, max_workers=None):
+    if max_workers is None:
+        max_workers = args.max_workers
+    scheduler_class = TaskScheduler
+    if args.engine == 'async':
+        from asyncutils import AsyncTaskScheduler
+
+        scheduler_class = AsyncTaskScheduler
+    return scheduler_class(max_workers=max_workers, num_trials=args.trials, backoff=args.backoff,
+                           endpoint_limit=args.endpoint_limit, adaptive=not args.no_adaptive, order=args.order,
+                           huge_size=args.huge_size, huge_limit=args.huge_limit)
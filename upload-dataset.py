@@ -1,30 +1,39 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # vim: set fileencoding=utf8 :
 
-from __future__ import print_function
-
 import argparse
+import asyncio
+import concurrent.futures
+import json
 import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-import concurrent.futures
 import requests
+
 from SPARQLWrapper import SPARQLWrapper, JSON
-from concurrent.futures import ThreadPoolExecutor
-import six
-from six.moves.urllib.parse import urlencode
-from six.moves.urllib.parse import quote_plus
-from six.moves.urllib.parse import unquote_plus
+from httputils import add_transport_arguments, create_session_from_args, is_length_required, FileBody
+from taskutils import add_scheduler_arguments, create_scheduler_from_args, task_endpoints
+from batchutils import BatchTask, add_batch_arguments, graph_term, make_batches, to_ntriples
+from metricsutils import ProgressBar, add_metrics_arguments, create_metrics_from_args, in_context
+from manifestutils import is_manifest_file
+from fileutils import detect_compression, iter_file_range, iter_graph_file, open_graph_file, split_statements
+from fileutils import ChunkReader
+from rdfutils import count_file_statements
+from fileutils import strip_compression_suffix
+from archiveutils import GraphArchive, is_archive
+from urllib.parse import quote_plus, unquote_plus, urlencode
 import os
 import os.path
 
-MAX_WORKERS = 5
-try:
-    import multiprocessing
+# Default size of chunks of graphs uploaded in chunks and number of chunks sent at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_CHUNK_PARALLELISM = 4
+
+COUNT_HEADERS = {'accept': 'application/sparql-results+json'}
 
-    MAX_WORKERS = multiprocessing.cpu_count() * 5
-except (ImportError, NotImplementedError):
-    pass
+# Memory used for sorting statements when repeated statements of a graph uploaded in chunks are counted
+COUNT_MEMORY_LIMIT = 64 * 1024 * 1024
 
 
 # https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
@@ -50,49 +59,274 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
-def progress(count, total, suffix=''):
-    bar_len = 60
-    filled_len = int(round(bar_len * count / float(total)))
-
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
-
-    sys.stdout.write('[%s] %s%s ...%s\r' % (bar, percents, '%', suffix))
-    sys.stdout.flush()  # As suggested by Rom Ruben
+# Rate-limited, not drawn when stdout is not a terminal
+progress = ProgressBar()
 
 
 class UploadTask(object):
+    put_headers = {
+        'content-type': "text/turtle",
+        'cache-control': "no-cache"
+    }
 
-    def __init__(self, graph_name, graph_file, dataset_url, verify=False):
+    def __init__(self, graph_name, graph_file, dataset_url, session, verify=False, archive=None, size=None):
         self.graph_name = graph_name
         self.graph_file = graph_file
+        self.size = size  # bytes used for scheduling
+        # Graphs in an archiveutils.GraphArchive are read from it as N-Triples
+        self.archive = archive
+        if archive is not None:
+            self.put_headers = dict(self.put_headers)
+            self.put_headers['content-type'] = "application/n-triples"
         self.dataset_url = dataset_url
+        self.session = session
         self.verify = verify
         query = {'graph': graph_name}
         ue_query = urlencode(query)
         self.put_url = dataset_url + '?' + ue_query
-        self.data = None
+        self.endpoints = task_endpoints(dataset_url)
         self.finished = False
 
+    def read(self):
+        if self.archive is not None:
+            return self.archive.read_ntriples(self.graph_name)
+        with open_graph_file(self.graph_file) as fd:
+            return fd.read()
+
+    def body(self):
+        """
+        :return: FileBody streaming the graph from its file or the archive
+        """
+        if self.archive is not None:
+            entry = self.archive.entry(self.graph_name)
+            return FileBody(lambda: self.archive.iter_ntriples(self.graph_name, entry),
+                            self.archive.ntriples_length(self.graph_name, entry['length'], entry['statements']))
+        # The length of decompressed content is not known in advance
+        length = None if detect_compression(self.graph_file) else os.path.getsize(self.graph_file)
+        return FileBody(lambda: iter_graph_file(self.graph_file), length)
+
+    def send(self, data, method="PUT"):
+        response = self.session.request(method, self.put_url, headers=self.put_headers, verify=self.verify, data=data)
+        response.raise_for_status()
+
+    async def send_async(self, data, method="PUT"):
+        headers = self.put_headers
+        if isinstance(data, FileBody):
+            if data.length is not None:
+                headers = dict(headers)
+                headers['content-length'] = str(data.length)
+            data = data.aiter()
+        response = await self.session.request(method, self.put_url, headers=headers, verify=self.verify, data=data)
+        response.raise_for_status()
+
     def run(self):
         if self.finished:
             return self
 
-        if self.data is None:
-            with open(self.graph_file, 'rb') as fd:
-                self.data = fd.read()
+        try:
+            self.send(self.body())
+        except requests.HTTPError as e:
+            if not is_length_required(e):
+                raise
+            # The server does not accept chunked bodies of compressed files, send the graph buffered
+            self.send(self.read())
+        self.finished = True
+        return self
 
-        put_headers = {
-            'content-type': "text/turtle",
-            'cache-control': "no-cache"
-        }
+    async def run_async(self):
+        """
+        Coroutine version of run() for the async engine, session must be an asyncutils.AsyncSession.
+        """
+        if self.finished:
+            return self
+
+        try:
+            await self.send_async(self.body())
+        except requests.HTTPError as e:
+            if not is_length_required(e):
+                raise
+            await self.send_async(self.read())
+        self.finished = True
+        return self
 
-        response = requests.request("PUT", self.put_url, headers=put_headers, verify=self.verify, data=self.data)
+
+class ChunkedUploadTask(UploadTask):
+    """
+    Uploads a large graph in chunks of whole lines of about chunk_size bytes, so that no single
+    request transfers the whole graph. The first chunk replaces the graph with PUT, the other
+    chunks are appended with POST, up to parallelism at a time. Appending a chunk again after
+    an ambiguous failure is harmless, as graphs are sets of triples. Finally the number of
+    triples in the graph is compared with the number of statements in the file. When the graph
+    has fewer triples, the distinct statements of the file are counted out of core. Graphs
+    which are not line based and graphs with blank nodes, which must not be split between
+    requests, are uploaded with a single request like by UploadTask. Compressed files are not
+    supported.
+    """
+
+    def __init__(self, graph_name, graph_file, dataset_url, session, verify=False, archive=None, size=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, parallelism=DEFAULT_CHUNK_PARALLELISM):
+        super(ChunkedUploadTask, self).__init__(graph_name, graph_file, dataset_url, session, verify=verify,
+                                                archive=archive, size=size)
+        self.chunk_size = chunk_size
+        self.parallelism = parallelism
+        self.entry = None  # entry of the graph in the archive
+        self.chunks = None  # list of ranges (start, end, number of statements), empty for uploads in one request
+        self.pending = None  # chunks not appended yet
+        self.statements = None  # number of distinct statements, counted when the store reports fewer triples
+        self.replaced = False
+
+    def content(self):
+        """
+        :return: iterator over the graph file, or its N-Quads in the archive
+        """
+        if self.archive is not None:
+            return self.archive.iter_raw(self.entry)
+        return iter_file_range(self.graph_file, 0, os.path.getsize(self.graph_file))
+
+    def scan(self):
+        if self.archive is not None:
+            self.entry = self.archive.entry(self.graph_name)
+        result = split_statements(self.content(), self.chunk_size)
+        if result is None or result[1] or len(result[0]) < 2:
+            self.chunks = []
+        else:
+            self.chunks = result[0]
+        self.pending = self.chunks[1:]
+
+    def chunk_body(self, chunk):
+        start, end, statements = chunk
+        if self.archive is not None:
+            return FileBody(lambda: self.archive.iter_ntriples(self.graph_name, self.entry, start, end),
+                            self.archive.ntriples_length(self.graph_name, end - start, statements))
+        return FileBody(lambda: iter_file_range(self.graph_file, start, end), end - start)
+
+    def count_url(self):
+        if self.graph_name == 'default':
+            pattern = '?s ?p ?o'
+        else:
+            pattern = 'GRAPH %s { ?s ?p ?o }' % graph_term(self.graph_name)
+        return self.dataset_url + '/sparql?' + urlencode({'query': 'SELECT (COUNT(*) AS ?n) WHERE { %s }' % pattern})
+
+    @staticmethod
+    def stored_count(response):
+        """
+        :return: number of triples in the graph from the response to the query of count_url()
+        """
         response.raise_for_status()
+        return int(json.loads(response.content)['results']['bindings'][0]['n']['value'])
+
+    def expected_count(self, count):
+        """
+        :return: number of triples the graph should have, when the store has fewer triples than the file
+                 has statements, repeated statements of the file are counted once
+        """
+        expected = sum(statements for start, end, statements in self.chunks)
+        if count < expected:
+            if self.statements is None:
+                self.statements = count_file_statements(ChunkReader(self.content()), COUNT_MEMORY_LIMIT)
+            expected = self.statements
+        return expected
+
+    def check_count(self, count, expected):
+        if count != expected:
+            # The next trial uploads the whole graph again
+            self.replaced = False
+            self.pending = self.chunks[1:]
+            raise Exception('graph %s has %i triples after upload instead of %i' % (self.graph_name, count, expected))
+
+    def run(self):
+        if self.finished:
+            return self
+
+        if self.chunks is None:
+            self.scan()
+        if not self.chunks:
+            return super(ChunkedUploadTask, self).run()
+
+        if not self.replaced:
+            self.send(self.chunk_body(self.chunks[0]))
+            self.replaced = True
+        errors = []
+        with ThreadPoolExecutor(self.parallelism) as executor:
+            futures = dict((executor.submit(in_context(self.send), self.chunk_body(chunk), "POST"), chunk)
+                           for chunk in self.pending)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    self.pending.remove(futures[future])
+                except Exception as e:
+                    errors.append(e)
+        if errors:
+            raise errors[0]
+
+        count = self.stored_count(self.session.request("GET", self.count_url(), headers=COUNT_HEADERS,
+                                                       verify=self.verify))
+        self.check_count(count, self.expected_count(count))
+        self.finished = True
+        return self
+
+    async def run_async(self):
+        """
+        Coroutine version of run() for the async engine, session must be an asyncutils.AsyncSession.
+        """
+        if self.finished:
+            return self
+
+        if self.chunks is None:
+            await asyncio.get_event_loop().run_in_executor(None, self.scan)
+        if not self.chunks:
+            return await super(ChunkedUploadTask, self).run_async()
+
+        if not self.replaced:
+            await self.send_async(self.chunk_body(self.chunks[0]))
+            self.replaced = True
+        semaphore = asyncio.Semaphore(self.parallelism)
+
+        async def append(chunk):
+            async with semaphore:
+                await self.send_async(self.chunk_body(chunk), "POST")
+            self.pending.remove(chunk)
+
+        results = await asyncio.gather(*[append(chunk) for chunk in list(self.pending)], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+
+        count = self.stored_count(await self.session.request("GET", self.count_url(), headers=COUNT_HEADERS,
+                                                             verify=self.verify))
+        # Repeated statements are counted by parsing the file, which must not block the event loop
+        expected = await asyncio.get_event_loop().run_in_executor(None, self.expected_count, count)
+        self.check_count(count, expected)
         self.finished = True
         return self
 
 
+class UploadBatchTask(BatchTask):
+    """
+    Uploads a batch of small graph files, or graphs of an archive, with a single request.
+    """
+
+    def __init__(self, graph_files, dataset_url, graphs, session, verify=False, method='update', archive=None,
+                 size=None):
+        super(UploadBatchTask, self).__init__(dataset_url, graphs, session, verify=verify, method=method, size=size)
+        self.graph_files = graph_files
+        self.archive = archive
+
+    def read(self, graph):
+        if self.archive is not None:
+            return self.archive.read_ntriples(graph)
+        with open_graph_file(self.graph_files[graph]) as fd:
+            return to_ntriples(fd.read())
+
+    def fetch(self, graphs):
+        return dict((g, self.read(g)) for g in graphs)
+
+    async def fetch_async(self, graphs):
+        # Graphs are parsed in a thread, so that the event loop is not blocked
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, in_context(self.fetch), graphs)
+
+
 def main():
     import ssl
 
@@ -103,85 +337,130 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument('--debug', help='debug mode', action="store_true")
-    parser.add_argument('src_dir', help='source directory')
+    add_transport_arguments(parser)
+    add_scheduler_arguments(parser, size_unit='bytes')
+    add_batch_arguments(parser, 'bytes')
+    add_metrics_arguments(parser)
+    parser.add_argument('--chunked', action='store_true',
+                        help='upload uncompressed graphs larger than --chunk-size in chunks of whole lines, the first '
+                             'chunk replaces the graph and the others are appended in parallel, graphs with blank '
+                             'nodes or statements spanning several lines are uploaded at once')
+    parser.add_argument('--chunk-size', metavar='BYTES', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='size of chunks of graphs uploaded in chunks')
+    parser.add_argument('--chunk-parallelism', metavar='N', type=int, default=DEFAULT_CHUNK_PARALLELISM,
+                        help='number of chunks of a graph uploaded at a time')
+    parser.add_argument('src_dir', help='source directory, or archive written by download-dataset.py --archive')
     parser.add_argument('url', help='url of the dataset')
 
     args = parser.parse_args()
 
     dataset_url = args.url
     src_dir = args.src_dir
+    metrics = create_metrics_from_args(args)
 
-    if not os.path.exists(src_dir):
+    archive = None
+    if is_archive(src_dir):
+        archive = GraphArchive(src_dir)
+    elif not os.path.exists(src_dir):
         print('Path', src_dir, 'does not exist', file=sys.stderr)
         return 1
-    if not os.path.isdir(src_dir):
+    elif not os.path.isdir(src_dir):
         print('Path', src_dir, 'is not a directory', file=sys.stderr)
         return 1
 
     print("Dataset URL:", dataset_url)
-    print("Source directory:", src_dir)
 
     graphs = {}
-    for i in os.listdir(src_dir):
-        path = os.path.join(src_dir, i)
-        if os.path.isfile(path):
-            graphs[unquote_plus(i)] = path
+    if archive is not None:
+        print("Source archive:", src_dir)
+        archive_sizes = archive.graphs()
+        graphs = dict((graph_name, None) for graph_name in archive_sizes)
+    else:
+        print("Source directory:", src_dir)
+        for i in os.listdir(src_dir):
+            path = os.path.join(src_dir, i)
+            if os.path.isfile(path) and not is_manifest_file(i):
+                # Files compressed by download-dataset.py --compress have the suffix of their compression
+                name = i
+                compression = detect_compression(path)
+                if compression is not None:
+                    name = strip_compression_suffix(name, compression)
+                graphs[unquote_plus(name)] = path
+
+    # Sizes of files or of graphs in the archive in bytes
+    if archive is not None:
+        sizes = archive_sizes
+    else:
+        sizes = dict((graph_name, os.path.getsize(graph_file)) for graph_name, graph_file in graphs.items())
 
     # get graphs
     l = len(graphs)
 
     print('Uploading', l, 'graphs to', dataset_url, '...')
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-
-        progress(0, l, suffix='Prepare tasks')
-        future_to_task = {}
-        i = 0
-        for graph_name, graph_file in six.iteritems(graphs):
-            task = UploadTask(graph_name, graph_file, dataset_url, verify=False)
-            future = executor.submit(task.run)
-            future_to_task[future] = task
-            progress(i + 1, l, suffix='Prepare tasks')
-            i += 1
-
-        num_trials = 3
-        trial = 0
-
-        while future_to_task:
-            trial += 1
-            repeat_tasks = []
-            l = len(future_to_task)
-            j = 0
-            for future in concurrent.futures.as_completed(future_to_task):
-                task = future_to_task[future]
-                progress(j, l,
-                         suffix='Upload data [%i / %i] in graph %s        ' % (trial, num_trials, task.graph_name))
-                try:
-                    future.result()
-                except Exception as exc:
-                    print()
-                    print('upload task for graph %s failed, exception: %s' % (task.graph_name, exc), file=sys.stderr)
-                    repeat_tasks.append(task)
-                else:
-                    # print('task success: %s' % (data,), file=sys.stderr) # DEBUG
-                    pass
-                j += 1
-
-            print()
+    session = create_session_from_args(args, args.max_workers)
+    scheduler = create_scheduler_from_args(args)
 
-            future_to_task.clear()
-            if repeat_tasks and trial < num_trials:
-                future_to_task = {executor.submit(task.run): task for task in repeat_tasks}
+    def on_progress(count, total, task):
+        progress(count, total, suffix='Upload data in graph %s        ' % task.graph_name)
 
+    def on_error(task, exc, trial, retry):
         print()
-        if repeat_tasks:
-            print('Could not upload data for following graphs:', file=sys.stderr)
-            for task in repeat_tasks:
-                print(task.graph_name, file=sys.stderr)
-            return 1
+        print('upload task for graph %s failed [%i / %i], exception: %s'
+              % (task.graph_name, trial, scheduler.num_trials, exc), file=sys.stderr)
+
+    def upload_task(graph_name):
+        graph_file = graphs[graph_name]
+        size = sizes[graph_name]
+        if args.chunked and size > args.chunk_size and (archive is not None or detect_compression(graph_file) is None):
+            return ChunkedUploadTask(graph_name, graph_file, dataset_url, session, verify=False, archive=archive,
+                                     size=size, chunk_size=args.chunk_size, parallelism=args.chunk_parallelism)
+        return UploadTask(graph_name, graph_file, dataset_url, session, verify=False, archive=archive, size=size)
+
+    if args.batch:
+        batches, large = make_batches(sorted(graphs), sizes, args.batch_bytes, args.batch_graphs)
+        tasks = [UploadBatchTask(graphs, dataset_url, batch, session, verify=False, method=args.batch_method,
+                                 archive=archive, size=sum(sizes[graph_name] for graph_name in batch))
+                 for batch in batches]
+        tasks.extend(upload_task(graph_name) for graph_name in large)
+        print('Uploading {} graphs in {} batches and {} graphs separately'.format(
+            sum(len(batch) for batch in batches), len(batches), len(large)))
+    else:
+        tasks = [upload_task(graph_name) for graph_name in graphs]
+    l = len(tasks)
+
+    progress(0, l, suffix='Upload data')
+    done_tasks, failed_tasks = scheduler.run(tasks, on_progress=on_progress, on_error=on_error)
+    print()
+    if archive is not None:
+        archive.close()
+
+    if metrics is not None:
+        metrics.close()
+        for line in metrics.summary():
+            print(line)
+
+    print()
+    failed_graphs = []
+    for task in done_tasks:
+        if isinstance(task, BatchTask):
+            for graph_name, exc in task.failed_graphs:
+                print('upload of graph %s was rejected, exception: %s' % (graph_name, exc), file=sys.stderr)
+                failed_graphs.append(graph_name)
+    for task in failed_tasks:
+        if isinstance(task, BatchTask):
+            failed_graphs.extend(graph_name for graph_name, exc in task.failed_graphs)
+            failed_graphs.extend(task.pending)
         else:
-            print('Successfuly uploaded all data')
-            return 0
+            failed_graphs.append(task.graph_name)
+    if failed_graphs:
+        print('Could not upload data for following graphs:', file=sys.stderr)
+        for graph_name in failed_graphs:
+            print(graph_name, file=sys.stderr)
+        return 1
+    else:
+        print('Successfuly uploaded all data')
+        return 0
 
 
 if __name__ == '__main__':